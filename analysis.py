@@ -1,6 +1,14 @@
 import csv
+import io
 import math
+import time
+import numpy as np
+import metrics
 from constants import FIELDS, load_LHA
+from columnar import Snapshot, is_snapshot
+from quantiles import DEFAULT_PERCENTAGES, KLLSketch, exact_quantiles, grouped_quantiles, normalise_percentage
+from watermark import file_watermark, resume_offset, load_state, save_state
+from records import COLUMNS, ListingTable, PHONE, EMAIL
 from datetime import datetime, timedelta
 
 
@@ -11,218 +19,422 @@ def round_up(n, decimals=0):
 def count_recent_scraped_listings(infile, diff=timedelta(days=7)):
     """Return the number of listings that were scraped within a specified time (default 1 week) of being listed"""
     with open(infile) as csvfile:
-        reader = csv.DictReader(csvfile)
-        return sum(1 for _ in filter(lambda row: datetime.strptime(row["Listed Date"], "%Y-%m-%d") >= datetime.strptime(row["Scraped Date"], "%Y-%m-%d %H:%M:%S") - diff, reader))
+        listings = ListingTable().read_csv(csvfile)
+        return sum(1 for listing in listings if listing.listed and listing.scraped and listing.listed >= listing.scraped - diff)
 
 
 def count_recent_listings(infile, diff=timedelta(days=7)):
     """Return the number of properties that were listed less than a specified time (default 1 week) ago"""
+    since = datetime.now() - diff
     with open(infile) as csvfile:
-        reader = csv.DictReader(csvfile)
-        return sum(1 for _ in filter(lambda row: datetime.strptime(row["Listed Date"], "%Y-%m-%d") >= datetime.now() - diff, reader))
+        listings = ListingTable().read_csv(csvfile)
+        return sum(1 for listing in listings if listing.listed and listing.listed >= since)
 
 
 def total_listings(infile, postcode=None, brma=None, cat=None):
     """Count the total number of listings found"""
 
+    table = ListingTable()
+    matches = table.matcher(postcode, brma, cat)
     with open(infile) as csvfile:
-        reader = csv.DictReader(csvfile)
-        return sum(1 for _ in filter(lambda row: (not postcode or row["Postcode (District)"].lower() == postcode.lower()) and (not brma or row["BRMA"].lower() == brma.lower()) and (not cat or row["Category"].lower() == cat.lower()), reader))
+        return sum(1 for listing in table.read_csv(csvfile) if matches(listing))
 
 
 def affordable_listings(infile, postcode=None, brma=None, cat=None, weekly_top_up=0):
     """Calculate how many of the listings are affordable for their particular BRMA
     Optionally, specify a particular postcode, BRMA, and Category to only consider properties that match these conditions.
-    Optionally, specify a "monthly top-up"; extra money that a person could put towards their rent, to factor into the affordability
+    Optionally, specify a "weekly top-up"; extra money that a person could put towards their rent, to factor into the affordability
     calculation
     """
 
     if cat and cat not in ["CAT A", "CAT B", "CAT C", "CAT D", "CAT E"]:
         raise ValueError("Category must be in form e.g. 'CAT A'")
 
-    with open(infile) as csvfile:
-        reader = csv.DictReader(csvfile)
-        filtered_rows = filter(lambda row: (not postcode or row["Postcode (District)"].lower() == postcode.lower()) and (not brma or row["BRMA"].lower() == brma.lower()) and (not cat or row["Category"].lower() == cat.lower()), reader)
+    weekly_LHA = load_LHA() if weekly_top_up else None
+    table = ListingTable()
+    matches = table.matcher(postcode, brma, cat)
 
-        return sum([1 for row in filtered_rows if row["Affordable"].lower() == "true"])
+    # The LHA rate for each (BRMA, category) pair of codes, looked up once
+    rates = {}
+
+    def lha_rate(listing):
+        key = (listing.brma, listing.category)
+        try:
+            return rates[key]
+        except KeyError:
+            try:
+                rate = float(weekly_LHA[table.brmas.values[listing.brma]][table.categories.values[listing.category]])
+            # Listings without a BRMA or category can't be affordable
+            except (KeyError, ValueError):
+                rate = None
+            rates[key] = rate
+            return rate
+
+    def affordable(listing):
+        if not weekly_top_up:
+            return listing.affordable
+        rate = lha_rate(listing)
+        # (Nor can listings without a rent, as comparisons with NaN are False)
+        return rate is not None and rate + weekly_top_up >= listing.rent
+
+    with open(infile) as csvfile:
+        return sum(1 for listing in table.read_csv(csvfile) if matches(listing) and affordable(listing))
 
 
 def required_LHA_percentile(infile, brma, cat, percentage=0.30):
     """Calculate the required increase in housing allowance (for a particular area and category of property) to make a given percentage of the market 'affordable'"""
 
+    table = ListingTable()
+    matches = table.matcher(brma=brma, cat=cat)
     with open(infile) as csvfile:
-        reader = csv.DictReader(csvfile)
-        filtered_rows = list(filter(lambda row: row["BRMA"].lower() == brma.lower() and row["Category"].lower() == cat.lower(), reader))
+        weekly_rents = [listing.rent for listing in table.read_csv(csvfile) if matches(listing) and not math.isnan(listing.rent)]
 
-        weekly_rents = []
-        for row in filtered_rows:
-            try:
-                weekly_rents.append((float(row["Monthly Rent"])*12)/52.1429)
-            except ValueError:
-                weekly_rents.append(float(row["Weekly Rent"]))
+    return exact_quantiles(weekly_rents, [percentage])[0]
 
-        sorted_rows = sorted(weekly_rents)
+CATEGORIES = ["CAT A", "CAT B", "CAT C", "CAT D", "CAT E"]
 
-        # Do best to convert if percentage is not given as decimal, e.g. 30
-        if percentage > 1:
-            percentage = percentage/100
 
-        try:
-            required_percentile = sorted_rows[int(len(sorted_rows)*percentage)]
-        except IndexError:
-            return None
+def percentile(weekly_rents, percentage=0.30):
+    """Return the rent at the given percentile of a list of rents (in the same way as required_LHA_percentile)"""
+    return exact_quantiles(weekly_rents, [percentage])[0]
 
-        return required_percentile
 
-def analysis_to_file(infile, outfile):
-    boundaries = []
+def group_percentile(group, percentage=0.30):
+    """Return the rent at the given percentile of a group, from its rents or (for an incremental run) its sketch of them"""
+    if "Sketch" in group:
+        return group["Sketch"].quantiles([percentage])[0]
+    return percentile(group["Rents"], percentage)
+
+
+def rent_percentiles(infile, percentages=DEFAULT_PERCENTAGES):
+    """Calculate several percentiles of rent for every BRMA and category in one pass over the properties file
+
+    Returns a dictionary keyed by (lower case) BRMA, then by (lower case) category, of the
+    rent at each of the given percentages (None where there are too few listings)
+    """
+
+    groups = aggregate_by_brma(infile)
+    rents = {brma: {cat: group["Rents"] for cat, group in categories.items()} for brma, categories in groups.items()}
+    return grouped_quantiles(rents, percentages)
+
+
+def percentiles_to_file(infile, outfile, percentages=DEFAULT_PERCENTAGES):
+    """Write several percentiles of rent for every BRMA and category (CAT A-E) to a file"""
+
+    def ordinal(percentage):
+        n = int(round(normalise_percentage(percentage) * 100))
+        suffix = "th" if 10 <= n % 100 <= 20 else {1: "st", 2: "nd", 3: "rd"}.get(n % 10, "th")
+        return "{}{}".format(n, suffix)
 
+    boundaries = []
     with open("weekly-lha.csv") as csvfile:
         reader = csv.DictReader(csvfile)
         for row in reader:
             boundaries.append(row["BRMA"])
 
+    groups = aggregate_by_brma(infile)
 
     with open(outfile, 'w', newline='') as csvfile:
         writer = csv.writer(csvfile)
+        writer.writerow(["Broad Rental Market Area", "Category", "Listings"] + ["{} percentile rent".format(ordinal(percentage)) for percentage in percentages])
 
-        writer.writerow([
-            "Broad Rental Market Area",
+        for boundary in boundaries:
+            brma_groups = groups.get(boundary.lower(), {})
+            for cat in CATEGORIES:
+                rents = brma_groups.get(cat.lower(), {"Rents": []})["Rents"]
+                values = exact_quantiles(rents, percentages)
+                writer.writerow([boundary, cat, len(rents)] + [round_up(value, 2) if value is not None else "-" for value in values])
 
-            # "Total Listings",
-            # "Affordable Listings",
-            # "(%)",
 
-            # "Total CAT A Listings",
-            # "Affordable CAT A Listings",
-            # "(%)",
+def aggregate_by_brma(infile):
+    """Read the properties file once, and count the listings (and collect their weekly rents) for every BRMA and category
 
-            # "Total CAT B Listings",
-            # "Affordable CAT B Listings",
-            # "(%)",
+    Returns a dictionary keyed by (lower case) BRMA, then by (lower case) category, of
+    {"Total": ..., "Affordable": ..., "Rents": [...]}
 
-            "Two-bed listings",
-            "Affordable two-bed listings",
-            "Affordable two-bed listings (%)",
-            "Current LHA per week",
-            "30th percentile rent",
-            "LHA/week increase required for 30% affordability",
-            "LHA/month increase required for 30% affordability"
+    The properties can be a CSV file or a columnar snapshot
+    """
 
-            # "Total CAT D Listings",
-            # "Affordable CAT D Listings",
-            # "(%)",
+    if is_snapshot(infile):
+        return aggregate_snapshot_by_brma(Snapshot(infile))
 
-            # "Total CAT E Listings",
-            # "Affordable CAT E Listings",
-            # "(%)"
-        ])
+    table = ListingTable()
+    with open(infile, newline='') as csvfile:
+        return aggregate_listings(table, table.read_csv(csvfile))
 
-        for boundary in boundaries:
 
-            print("Analysing {}...".format(boundary))
+def aggregate_rows(rows, groups=None):
+    """Add the counts and rents of some rows (dictionaries, as read from a properties file) to the given groups"""
+    table = ListingTable()
+    return aggregate_listings(table, table.read(rows), groups)
 
-            # total = total_listings(infile, brma=boundary)
-            # affordable = affordable_listings(infile, brma=boundary)
-            # percent = round((affordable/total)*100, 2)
 
-            # total_cat_a = total_listings(brma=boundary, cat="CAT A")
-            # affordable_cat_a = affordable_listings(brma=boundary, cat="CAT A") if total_cat_a > 0 else 0
-            # percent_cat_a = round((affordable_cat_a/total_cat_a)*100, 2) if total_cat_a > 100 else "-"
+def aggregate_listings(table, listings, groups=None):
+    """Add the counts and rents of some Listings (read by the given ListingTable) to the given groups"""
 
-            # total_cat_b = total_listings(brma=boundary, cat="CAT B")
-            # affordable_cat_b = affordable_listings(brma=boundary, cat="CAT B") if total_cat_b > 0 else 0
-            # percent_cat_b = round((affordable_cat_b/total_cat_b)*100, 2) if total_cat_b > 100 else "-"
+    if groups is None:
+        groups = {}
 
-            total_cat_c = total_listings(infile, brma=boundary, cat="CAT C")
-            affordable_cat_c = affordable_listings(infile, brma=boundary, cat="CAT C") if total_cat_c > 0 else 0
-            percent_cat_c = round((affordable_cat_c/total_cat_c), 4) if total_cat_c >= 100 else "-"
-            weekly_LHA_cat_c = float(load_LHA()[boundary]["CAT C"])
-            percentile_cat_c = required_LHA_percentile(infile, brma=boundary, cat="CAT C", percentage=0.30)
-            percentile_rounded_cat_c = round_up(percentile_cat_c, 2) if percentile_cat_c else "-"
-            increase_cat_c = max(round_up(percentile_cat_c - weekly_LHA_cat_c, 2), 0.00) if percentile_cat_c else "-"
-            increase_monthly_cat_c = max(round_up((((percentile_cat_c - weekly_LHA_cat_c) * 52.1429) / 12), 2), 0.00) if percentile_cat_c else "-"
+    # Group the listings by the codes of their (lower case) BRMA and category
+    brmas, categories = table.brmas.lowered, table.categories.lowered
+    counts = {}
+    for listing in listings:
+        key = (brmas[listing.brma], categories[listing.category])
+        try:
+            group = counts[key]
+        except KeyError:
+            group = counts[key] = {"Total": 0, "Affordable": 0, "Rents": []}
+
+        group["Total"] += 1
+        if listing.affordable:
+            group["Affordable"] += 1
+        if not math.isnan(listing.rent):
+            group["Rents"].append(listing.rent)
+
+    for (brma, cat), group in counts.items():
+        brma_groups = groups.setdefault(table.brmas.lower_values[brma], {})
+        try:
+            existing = brma_groups[table.categories.lower_values[cat]]
+        except KeyError:
+            brma_groups[table.categories.lower_values[cat]] = group
+            continue
+        existing["Total"] += group["Total"]
+        existing["Affordable"] += group["Affordable"]
+        existing["Rents"].extend(group["Rents"])
 
-            # total_cat_d = total_listings(brma=boundary, cat="CAT D")
-            # affordable_cat_d = affordable_listings(brma=boundary, cat="CAT D") if total_cat_d > 0 else 0
-            # percent_cat_d = round((affordable_cat_d/total_cat_d)*100, 2) if total_cat_d > 100 else "-"
+    return groups
 
-            # total_cat_e = total_listings(brma=boundary, cat="CAT E")
-            # affordable_cat_e = affordable_listings(brma=boundary, cat="CAT E") if total_cat_e > 0 else 0
-            # percent_cat_e = round((affordable_cat_e/total_cat_e)*100, 2) if total_cat_e > 100 else "-"
 
+def sketch_groups(groups, sketched=None):
+    """Add groups from aggregate_by_brma to groups that keep a KLLSketch of their rents (under "Sketch") in place of the rents"""
 
-            writer.writerow([
-                boundary,
+    if sketched is None:
+        sketched = {}
 
-                # total,
-                # affordable,
-                # percent,
+    for brma, categories in groups.items():
+        for cat, group in categories.items():
+            brma_sketched = sketched.setdefault(brma, {})
+            try:
+                existing = brma_sketched[cat]
+            except KeyError:
+                existing = brma_sketched[cat] = {"Total": 0, "Affordable": 0, "Sketch": KLLSketch(seed=0)}
+            existing["Total"] += group["Total"]
+            existing["Affordable"] += group["Affordable"]
+            existing["Sketch"].extend(group["Rents"])
+
+    return sketched
 
-                # total_cat_a,
-                # affordable_cat_a,
-                # percent_cat_a,
-                # required_LHA_increase(infile, brma=boundary, cat="CAT A", percentage=0.3),
 
-                # total_cat_b,
-                # affordable_cat_b,
-                # percent_cat_b,
-                # required_LHA_increase(infile, brma=boundary, cat="CAT B", percentage=0.3),
+def aggregate_new_rows(infile, state_file):
+    """Update the groups saved by the last incremental run with the rows added to a properties file since
 
+    Only the counts and a KLLSketch of the rents are saved for each group, so an update
+    takes time in proportion to the new rows rather than to every row so far. Percentiles
+    from the sketches are approximate once a group has more than a couple of hundred
+    rents (exact percentiles need every rent, i.e. a full run)
+
+    If there is no saved state, or the file has been changed other than by appending to
+    it, the whole file is aggregated again (and the exact groups returned). The updated
+    state is saved either way
+    """
+
+    state = load_state(state_file)
+    offset = resume_offset(state.get("input"), infile) if "sketches" in state else None
+
+    if offset is None:
+        groups = aggregate_by_brma(infile)
+        sketched = sketch_groups(groups)
+    else:
+        sketched = {brma: {cat: {"Total": group["Total"], "Affordable": group["Affordable"],
+                                 "Sketch": KLLSketch.from_dict(group["Sketch"], seed=0)}
+                           for cat, group in categories.items()}
+                    for brma, categories in state["sketches"].items()}
+        with open(infile, 'rb') as rawfile:
+            rawfile.seek(offset)
+            table = ListingTable()
+            listings = table.read(csv.reader(io.TextIOWrapper(rawfile, newline='')), [FIELDS.index(name) for name in COLUMNS])
+            groups = sketch_groups(aggregate_listings(table, listings), sketched)
+
+    sketches = {brma: {cat: dict(group, Sketch=group["Sketch"].to_dict()) for cat, group in categories.items()}
+                for brma, categories in sketched.items()}
+    save_state(state_file, {"input": file_watermark(infile), "sketches": sketches})
+    return groups
+
+
+def aggregate_snapshot_by_brma(snapshot):
+    """Equivalent of aggregate_by_brma for a columnar snapshot, only reading the columns needed"""
+
+    brmas, brma_codes = snapshot.lower_codes("BRMA")
+    cats, cat_codes = snapshot.lower_codes("Category")
+    affordable = np.array([value.lower() == "true" for value in snapshot.categories("Affordable")], dtype=bool)
+    affordable = affordable[np.asarray(snapshot.column("Affordable"))]
+
+    monthly = np.asarray(snapshot.column("Monthly Rent"))
+    weekly = np.asarray(snapshot.column("Weekly Rent"))
+    rents = np.where(np.isnan(monthly), weekly, (monthly*12)/52.1429)
+
+    keys = brma_codes * len(cats) + cat_codes
+    order = np.argsort(keys, kind='stable')
+    unique_keys, starts, totals = np.unique(keys[order], return_index=True, return_counts=True)
+    affordable_counts = np.add.reduceat(affordable[order].astype(np.int64), starts) if len(order) else []
+
+    groups = {}
+    for key, start, total, affordable_count in zip(unique_keys, starts, totals, affordable_counts):
+        group_rents = rents[order[start:start + total]]
+        groups.setdefault(brmas[key // len(cats)], {})[cats[key % len(cats)]] = {
+            "Total": int(total),
+            "Affordable": int(affordable_count),
+            "Rents": group_rents[~np.isnan(group_rents)].tolist()
+        }
+
+    return groups
+
+
+def combine_groups(groups):
+    """Combine the counts and rents of several groups from aggregate_by_brma (or sketch_groups)"""
+    combined = {"Total": 0, "Affordable": 0, "Rents": [], "Sketch": KLLSketch(seed=0)}
+    for group in groups:
+        combined["Total"] += group["Total"]
+        combined["Affordable"] += group["Affordable"]
+        if "Sketch" in group:
+            combined["Sketch"].merge(group["Sketch"])
+        else:
+            combined["Rents"].extend(group["Rents"])
+    if combined["Sketch"].count:
+        combined["Sketch"].extend(combined["Rents"])
+        del combined["Rents"]
+    else:
+        del combined["Sketch"]
+    return combined
+
+
+def analysis_to_file(infile, outfile, all_categories=False, incremental=False):
+    """Write the summary figures per BRMA to a file
+
+    By default only two-bed (CAT C) figures are written. Set `all_categories` to also write
+    the total and affordable listings across all categories, and for every other category
+
+    Optionally, set `incremental` to keep the counts and a sketch of the rents per BRMA
+    alongside the output file, so the next incremental run only has to read the properties
+    added since (for a CSV file that is only ever appended to). Percentiles are then
+    approximate (see aggregate_new_rows)
+    """
+
+    with metrics.timer("analysis.aggregate_seconds"):
+        if incremental and not is_snapshot(infile):
+            groups = aggregate_new_rows(infile, outfile + ".analysis-state")
+        else:
+            groups = aggregate_by_brma(infile)
+
+    write_analysis(groups, outfile, all_categories)
+
+
+def write_analysis(groups, outfile, all_categories=False):
+    """Write the summary figures per BRMA to a file, from the groups made by aggregate_by_brma (see analysis_to_file)"""
+
+    boundaries = []
+
+    with open("weekly-lha.csv") as csvfile:
+        reader = csv.DictReader(csvfile)
+        for row in reader:
+            boundaries.append(row["BRMA"])
+
+    weekly_LHA = load_LHA()
+    empty = {"Total": 0, "Affordable": 0, "Rents": []}
+
+    def listing_columns(group):
+        total = group["Total"]
+        affordable = group["Affordable"] if total > 0 else 0
+        percent = round((affordable/total), 4) if total >= 100 else "-"
+        return [total, affordable, percent]
+
+    def listing_headers(name):
+        return [
+            "{} listings".format(name),
+            "Affordable {} listings".format(name),
+            "Affordable {} listings (%)".format(name)
+        ]
+
+    with open(outfile, 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile)
+
+        header = ["Broad Rental Market Area"]
+        if all_categories:
+            header += ["Total listings", "Affordable listings", "Affordable listings (%)"]
+            header += listing_headers("CAT A") + listing_headers("CAT B")
+        header += [
+            "Two-bed listings",
+            "Affordable two-bed listings",
+            "Affordable two-bed listings (%)",
+            "Current LHA per week",
+            "30th percentile rent",
+            "LHA/week increase required for 30% affordability",
+            "LHA/month increase required for 30% affordability"
+        ]
+        if all_categories:
+            header += listing_headers("CAT D") + listing_headers("CAT E")
+        writer.writerow(header)
+
+        for boundary in boundaries:
+            start = time.perf_counter()
+            brma_groups = groups.get(boundary.lower(), {})
+
+            def category(cat):
+                return brma_groups.get(cat.lower(), empty)
+
+            total_cat_c, affordable_cat_c, percent_cat_c = listing_columns(category("CAT C"))
+            weekly_LHA_cat_c = float(weekly_LHA[boundary]["CAT C"])
+            percentile_cat_c = group_percentile(category("CAT C"), 0.30)
+            percentile_rounded_cat_c = round_up(percentile_cat_c, 2) if percentile_cat_c else "-"
+            increase_cat_c = max(round_up(percentile_cat_c - weekly_LHA_cat_c, 2), 0.00) if percentile_cat_c else "-"
+            increase_monthly_cat_c = max(round_up((((percentile_cat_c - weekly_LHA_cat_c) * 52.1429) / 12), 2), 0.00) if percentile_cat_c else "-"
+
+            row = [boundary]
+            if all_categories:
+                row += listing_columns(combine_groups(brma_groups.values()))
+                row += listing_columns(category("CAT A")) + listing_columns(category("CAT B"))
+            row += [
                 total_cat_c,
                 affordable_cat_c,
                 percent_cat_c,
                 weekly_LHA_cat_c,
                 percentile_rounded_cat_c,
                 increase_cat_c,
-                increase_monthly_cat_c,
-
-                # total_cat_d,
-                # affordable_cat_d,
-                # percent_cat_d,
-                # required_LHA_increase(infile, brma=boundary, cat="CAT D", percentage=0.3),
-
-                # total_cat_e,
-                # affordable_cat_e,
-                # percent_cat_e
-                # required_LHA_increase(infile, brma=boundary, cat="CAT E", percentage=0.3),
-
-            ])
+                increase_monthly_cat_c
+            ]
+            if all_categories:
+                row += listing_columns(category("CAT D")) + listing_columns(category("CAT E"))
+            writer.writerow(row)
+            metrics.observe("analysis.brma_seconds", time.perf_counter() - start, brma=boundary)
 
     print("Analysis complete")
 
 
 def create_overview_by_brma(infile, outfile):
+    # Counts for each BRMA, keyed by its code
     locations = {}
+    table = ListingTable()
 
     with open(infile, 'r', newline='') as csvfile:
-        reader = csv.DictReader(csvfile, fieldnames=FIELDS)
-        next(reader)
-        for row in reader:
+        for listing in table.read_csv(csvfile):
             try:
-                x = locations[row["BRMA"]]
+                location = locations[listing.brma]
             except KeyError:
-                locations[row["BRMA"]] = {}
-                locations[row["BRMA"]]["Total"] = 0
-                locations[row["BRMA"]]["Affordable"] = 0
-                locations[row["BRMA"]]["Both"] = 0
-                locations[row["BRMA"]]["Phone"] = 0
-                locations[row["BRMA"]]["Email"] = 0
-                locations[row["BRMA"]]["Neither"] = 0
-
-            locations[row["BRMA"]]["Total"] += 1
-
-            if row["Affordable"].lower() == "true":
-                locations[row["BRMA"]]["Affordable"] += 1
-
-                if row["Contact Email"] and row["Contact Phone"]:
-                    locations[row["BRMA"]]["Both"] += 1
-                elif row["Contact Phone"]:
-                    locations[row["BRMA"]]["Phone"] += 1
-                elif row["Contact Email"]:
-                    locations[row["BRMA"]]["Email"] += 1
+                location = locations[listing.brma] = {"Total": 0, "Affordable": 0, "Both": 0, "Phone": 0, "Email": 0, "Neither": 0}
+
+            location["Total"] += 1
+
+            if listing.affordable:
+                location["Affordable"] += 1
+
+                if listing.contact == PHONE | EMAIL:
+                    location["Both"] += 1
+                elif listing.contact & PHONE:
+                    location["Phone"] += 1
+                elif listing.contact & EMAIL:
+                    location["Email"] += 1
                 else:
-                    locations[row["BRMA"]]["Neither"] += 1
+                    location["Neither"] += 1
 
 
     with open(outfile, 'w', newline='') as outcsv:
@@ -230,7 +442,7 @@ def create_overview_by_brma(infile, outfile):
         writer.writeheader()
         for location in locations:
             writer.writerow({
-                "BRMA": location,
+                "BRMA": table.brmas.values[location],
                 "Total": locations[location]["Total"],
                 "Affordable": locations[location]["Affordable"],
                 "Both": locations[location]["Both"],
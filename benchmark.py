@@ -0,0 +1,437 @@
+import argparse
+import csv
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+import tracemalloc
+import numpy as np
+from datetime import datetime, timedelta
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from tempfile import mkdtemp
+from urllib.parse import urlsplit, parse_qs
+from constants import FIELDS, load_LHA
+
+
+DISTRICTS_FILE = "postcode-districts.csv"
+BASELINE_FILE = "benchmark-baseline.json"
+
+# Rows written to a synthetic properties file at a time
+GENERATOR_CHUNK = 100000
+
+# Share of synthetic listings that are another listing for a property already listed
+DUPLICATE_RATE = 0.15
+
+# Share of listings for each number of bedrooms (0-5), of listings from a flat-share
+# site (which are treated as CAT A), and of rents that are given per month
+BEDROOM_SHARES = [0.05, 0.30, 0.38, 0.19, 0.06, 0.02]
+SHARED_SHARE = 0.05
+MONTHLY_SHARE = 0.8
+
+# Typical weekly rent for each number of bedrooms, before local variation
+BEDROOM_RENTS = [95, 125, 165, 205, 265, 340]
+
+# Spread of rents around their typical level (the standard deviation of their logarithm), and
+# the level of each BRMA's rents as a multiple of its LHA rates (set at the 30th percentile)
+RENT_SPREAD = 0.3
+LHA_RENT_RATIO = 1.17
+
+SOURCES = ["OnTheMarket.com", "Home.co.uk", "Zoopla", "Gumtree", "Rightmove"]
+
+# Number of postcode districts crawled from the fake API
+CRAWL_POSTCODES = 200
+
+STAGES = ["snapshot_properties", "remove_duplicates", "apply_boundaries", "analysis_to_file", "create_overview_by_brma"]
+
+
+def load_district_locations(infile=DISTRICTS_FILE):
+    """Return the postcode districts with a location, their latitudes, longitudes and relative sizes"""
+
+    names, latitudes, longitudes, weights = [], [], [], []
+    with open(infile) as csvfile:
+        reader = csv.DictReader(csvfile)
+        for row in reader:
+            if not row["Latitude"]:
+                continue
+            names.append(row["Postcode"])
+            latitudes.append(float(row["Latitude"]))
+            longitudes.append(float(row["Longitude"]))
+            # Weight districts by their number of households (or active postcodes, if unknown)
+            weights.append(float(row["Households"] or 0) or float(row["Active postcodes"] or 0) * 20 or 1)
+
+    return names, np.array(latitudes), np.array(longitudes), np.array(weights)
+
+
+def _uniform(ids, salt):
+    """Return a uniform [0, 1) value for each id, the same every time for the same id and salt"""
+
+    # SplitMix64 finaliser
+    with np.errstate(over='ignore'):
+        x = ids.astype(np.uint64) * np.uint64(0x9E3779B97F4A7C15) + np.uint64(salt * 0xBF58476D1CE4E5B9 & 0xFFFFFFFFFFFFFFFF)
+        x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        x = x ^ (x >> np.uint64(31))
+    return (x >> np.uint64(11)).astype(np.float64) / float(1 << 53)
+
+
+def generate_properties(outfile, rows, seed=0, duplicate_rate=DUPLICATE_RATE):
+    """Write a synthetic properties file (in the format of FIELDS) of the given number of rows
+
+    Properties are spread over the postcode districts in proportion to their size, with a
+    realistic mix of bedrooms and rents. About `duplicate_rate` of the listings are another
+    listing for a property listed earlier in the file (with the same details and the same
+    URL, apart from its title), as found when scraping. The same seed always gives the same file
+
+    Each district is given one of the BRMAs in weekly-lha.csv, so BRMAs have as many
+    listings as their districts do between them. Rents are spread around each BRMA's LHA
+    rates (about 30% of them affordable), and BRMA and Affordable are filled in as
+    apply_boundaries would
+    """
+
+    names, latitudes, longitudes, weights = load_district_locations()
+    cumulative = np.cumsum(weights) / weights.sum()
+    bedroom_cumulative = np.cumsum(BEDROOM_SHARES)
+
+    weekly_LHA = load_LHA()
+    brmas = list(weekly_LHA)
+    district_brma = (_uniform(np.arange(len(names)), seed + 101) * len(brmas)).astype(np.int64)
+    # The LHA rate for each BRMA and category (CAT A to E), with a rate for larger properties (N/A) scaled up from CAT E
+    rates = np.array([[float(weekly_LHA[brma]["CAT {}".format(cat)]) for cat in "ABCDE"] for brma in brmas])
+    rates = np.hstack([rates, rates[:, 4:] * BEDROOM_RENTS[5] / BEDROOM_RENTS[4]])
+
+    rng = np.random.RandomState(seed)
+    scraped = datetime(2019, 8, 1)
+    properties = 0
+
+    with open(outfile, 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(FIELDS)
+
+        for start in range(0, rows, GENERATOR_CHUNK):
+            n = min(GENERATOR_CHUNK, rows - start)
+
+            # Each listing is either for a new property, or another listing for an earlier one
+            duplicate = rng.random_sample(n) < duplicate_rate
+            if properties == 0:
+                duplicate[0] = False
+            new = np.cumsum(~duplicate) - 1 + properties
+            ids = np.where(duplicate, (rng.random_sample(n) * np.maximum(new, 1)).astype(np.int64), new)
+            properties += int(np.count_nonzero(~duplicate))
+
+            # Every detail of a property is derived from its id, so duplicates match
+            district = np.minimum(np.searchsorted(cumulative, _uniform(ids, seed + 1)), len(names) - 1)
+            lat = latitudes[district] + (_uniform(ids, seed + 2) - 0.5) * 0.04
+            lon = longitudes[district] + (_uniform(ids, seed + 3) - 0.5) * 0.06
+            bedrooms = np.minimum(np.searchsorted(bedroom_cumulative, _uniform(ids, seed + 4)), len(BEDROOM_SHARES) - 1)
+            shared = _uniform(ids, seed + 5) < SHARED_SHARE
+            brma = district_brma[district]
+            # Column of `rates` for each listing's category (CAT A for shared properties, N/A for five or more bedrooms)
+            rate_column = np.where(shared, 0, np.maximum(bedrooms, 1))
+            normal = np.sqrt(-2 * np.log(1 - _uniform(ids, seed + 6))) * np.cos(2 * np.pi * _uniform(ids, seed + 7))
+            weekly = rates[brma, rate_column] * LHA_RENT_RATIO * np.exp(RENT_SPREAD * normal)
+            monthly = _uniform(ids, seed + 8) < MONTHLY_SHARE
+            source = (_uniform(ids, seed + 9) * len(SOURCES)).astype(np.int64)
+            listed_days = rng.randint(0, 30, size=n)
+
+            for i in range(n):
+                beds = int(bedrooms[i])
+                if shared[i]:
+                    cat = "CAT A"
+                elif beds <= 1:
+                    cat = "CAT B"
+                elif beds <= 4:
+                    cat = "CAT {}".format("CDE"[beds - 2])
+                else:
+                    cat = "N/A"
+
+                # Affordability is worked out from the rent as written, as apply_boundaries does
+                weekly_rent = int(round(weekly[i]))
+                monthly_rent = int(round(weekly[i] * 52.1429 / 12))
+                rent = (monthly_rent * 12) / 52.1429 if monthly[i] else weekly_rent
+                affordable = "" if cat == "N/A" else rates[brma[i], rate_column[i]] >= rent
+
+                row_scraped = scraped + timedelta(seconds=(start + i) // 50)
+                postcode = names[district[i]]
+                writer.writerow([
+                    row_scraped.strftime("%Y-%m-%d %H:%M:%S"),
+                    (row_scraped - timedelta(days=int(listed_days[i]))).strftime("%Y-%m-%d"),
+                    round(float(lat[i]), 6),
+                    round(float(lon[i]), 6),
+                    "{} bed flat to rent in {}".format(beds, postcode),
+                    postcode,
+                    brmas[brma[i]],
+                    beds,
+                    cat,
+                    "" if monthly[i] else weekly_rent,
+                    monthly_rent if monthly[i] else "",
+                    affordable,
+                    "Nestoria",
+                    "Ideal flatmate" if shared[i] else SOURCES[source[i]],
+                    "https://www.example.co.uk/detail/{}/title/{}".format(ids[i], start + i),
+                    "",
+                    "",
+                    "",
+                    "A {} bedroom property in {}, close to local amenities".format(beds, postcode),
+                    "",
+                    ""
+                ])
+
+    return properties
+
+
+class FakeNestoria(object):
+    """A local stand-in for the Nestoria API, serving paginated search results like the real one
+
+    Each postcode district has between one and `max_pages` pages of `results_per_page`
+    listings near its centre. Results depend only on the seed, postcode and page, and some
+    listings appear under more than one district, as they do in the real API. Use as a
+    context manager, with `url` as the api_url for snapshot_properties
+    """
+
+    def __init__(self, seed=0, max_pages=2, results_per_page=50, properties=50000):
+        names, latitudes, longitudes, _ = load_district_locations()
+        self.locations = {name: (lat, lon) for name, lat, lon in zip(names, latitudes, longitudes)}
+        self.seed = seed
+        self.max_pages = max_pages
+        self.results_per_page = results_per_page
+        self.properties = properties
+        self.requests = 0
+        self.server = None
+
+    def payload(self, postcode, page):
+        """Return the response to a search for the given postcode and page"""
+
+        rnd = random.Random("{}-{}-{}".format(self.seed, postcode, page))
+        total_pages = random.Random("{}-{}".format(self.seed, postcode)).randint(1, self.max_pages)
+        lat, lon = self.locations.get(postcode, (51.5, -0.1))
+
+        listings = []
+        if page <= total_pages:
+            for i in range(self.results_per_page):
+                beds = rnd.choice([0, 1, 1, 2, 2, 2, 3, 3, 4, 5, ""])
+                price_type = "monthly" if rnd.random() < MONTHLY_SHARE else "weekly"
+                weekly = BEDROOM_RENTS[beds or 0] * rnd.lognormvariate(0, 0.3)
+                listings.append({
+                    "title": "{} bed flat to rent in {}".format(beds, postcode),
+                    "latitude": round(lat + rnd.uniform(-0.02, 0.02), 6),
+                    "longitude": round(lon + rnd.uniform(-0.03, 0.03), 6),
+                    "price": int(weekly * 52.1429 / 12) if price_type == "monthly" else int(weekly),
+                    "price_type": price_type,
+                    "bedroom_number": beds,
+                    "datasource_name": "Ideal flatmate" if rnd.random() < SHARED_SHARE else rnd.choice(SOURCES),
+                    "updated_in_days": rnd.randint(0, 30),
+                    "lister_url": "https://www.example.co.uk/detail/{}/title/{}-{}".format(rnd.randrange(self.properties), postcode, page),
+                    "img_url": "",
+                    "summary": "A {} bedroom property in {}".format(beds, postcode)
+                })
+
+        return {"response": {"listings": listings, "page": page, "total_pages": total_pages, "total_results": total_pages * self.results_per_page}}
+
+    def start(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                query = parse_qs(urlsplit(self.path).query)
+                fake.requests += 1
+                body = json.dumps(fake.payload(query["place_name"][0], int(query["page"][0]))).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}/api".format(self.server.server_address[1])
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+def file_digest(path):
+    """Return a hash of a file's contents, to check a stage's output hasn't changed"""
+    sha = hashlib.sha256()
+    with open(path, 'rb') as infile:
+        for block in iter(lambda: infile.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def time_stage(name, function, *args, **kwargs):
+    """Run a stage, returning how long it took, the most memory it allocated (in MB) and its result"""
+
+    print("[*] Running {}....".format(name))
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        result = function(*args, **kwargs)
+        seconds = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    print("[*] {} took {:.2f}s (peak memory {:.1f} MB)".format(name, seconds, peak / 2**20))
+    return {"seconds": round(seconds, 3), "peak_memory_mb": round(peak / 2**20, 1)}, result
+
+
+def run_benchmark(rows=10000, seed=0, workdir=None, stages=STAGES, workers=1, duplicate_rate=DUPLICATE_RATE,
+                  crawl_postcodes=CRAWL_POSTCODES):
+    """Generate a synthetic properties file and time each stage of the pipeline on it
+
+    Stages are run from the repository directory (as they read the LHA rates, BRMA files
+    and postcode districts from there), writing their output to `workdir`. Stages that
+    can't be run (apply_boundaries, without the BRMA shapefile) are skipped. The crawl is
+    made against a FakeNestoria, for the last `crawl_postcodes` postcode districts
+    """
+
+    from properties import snapshot_properties
+    from districts import load_districts
+    from cleaner import remove_duplicates
+    from analysis import analysis_to_file, create_overview_by_brma
+    import properties
+
+    workdir = workdir or mkdtemp(prefix="lha-benchmark-")
+    os.makedirs(workdir, exist_ok=True)
+
+    def path(name):
+        return os.path.join(workdir, name)
+
+    results = {"rows": rows, "seed": seed, "duplicate_rate": duplicate_rate, "crawl_postcodes": crawl_postcodes, "date": datetime.now().strftime("%Y-%m-%d %H:%M:%S"), "stages": {}}
+
+    print("[*] Generating {} synthetic properties in {}".format(rows, workdir))
+    start = time.perf_counter()
+    generate_properties(path("properties.csv"), rows, seed, duplicate_rate)
+    print("[*] Generated in {:.2f}s".format(time.perf_counter() - start))
+
+    if "snapshot_properties" in stages:
+        for name in ("crawl.csv", "crawl.csv.journal"):
+            if os.path.isfile(path(name)):
+                os.remove(path(name))
+
+        # The fake API doesn't need to be rate limited. Crawl two-bed properties, as for the investigation
+        delay, properties.DELAY = properties.DELAY, 0.001
+        try:
+            with FakeNestoria(seed) as fake:
+                start_from = list(load_districts())[-crawl_postcodes]
+                stats, _ = time_stage("snapshot_properties", snapshot_properties, path("crawl.csv"), start_from=start_from,
+                                      min_beds=2, max_beds=2, api_url=fake.url, workers=max(workers, 4))
+                stats["requests"] = fake.requests
+        finally:
+            properties.DELAY = delay
+        # Listings are dated when they are fetched, so count them rather than comparing the file
+        with open(path("crawl.csv"), newline='') as crawled:
+            stats["result"] = sum(1 for _ in csv.reader(crawled)) - 1
+        results["stages"]["snapshot_properties"] = stats
+
+    if "remove_duplicates" in stages:
+        stats, dropped = time_stage("remove_duplicates", remove_duplicates, path("properties.csv"), path("deduplicated.csv"))
+        stats["result"] = dropped
+        stats["output"] = file_digest(path("deduplicated.csv"))
+        results["stages"]["remove_duplicates"] = stats
+    else:
+        os.replace(path("properties.csv"), path("deduplicated.csv"))
+
+    if "apply_boundaries" in stages:
+        from boundaries import BOUNDARY_FILE, apply_boundaries
+        if os.path.isfile(BOUNDARY_FILE + ".shp"):
+            stats, _ = time_stage("apply_boundaries", apply_boundaries, path("deduplicated.csv"), path("deduplicated.csv"), overwrite=True, workers=workers)
+            stats["output"] = file_digest(path("deduplicated.csv"))
+            results["stages"]["apply_boundaries"] = stats
+        else:
+            print("[!] Skipping apply_boundaries, as there is no BRMA shapefile at {}.shp".format(BOUNDARY_FILE))
+
+    if "analysis_to_file" in stages:
+        stats, _ = time_stage("analysis_to_file", analysis_to_file, path("deduplicated.csv"), path("analysis.csv"))
+        stats["output"] = file_digest(path("analysis.csv"))
+        results["stages"]["analysis_to_file"] = stats
+
+    if "create_overview_by_brma" in stages:
+        stats, _ = time_stage("create_overview_by_brma", create_overview_by_brma, path("deduplicated.csv"), path("overview.csv"))
+        stats["output"] = file_digest(path("overview.csv"))
+        results["stages"]["create_overview_by_brma"] = stats
+
+    return results
+
+
+def compare_to_baseline(results, baseline, tolerance=0.2):
+    """Print how each stage compares with a baseline run, returning whether any got slower or changed its output
+
+    A stage is slower if it took more than `tolerance` (as a fraction) longer than in the
+    baseline. Outputs are only compared when both runs used the same rows and seed
+    """
+
+    same_data = all(results.get(key) == baseline.get(key) for key in ("rows", "seed", "duplicate_rate", "crawl_postcodes"))
+    if not same_data:
+        print("[!] The baseline was run on different data, so only timings are compared")
+
+    regressed = False
+    for name, stats in results["stages"].items():
+        try:
+            base = baseline["stages"][name]
+        except KeyError:
+            print("[*] {}: not in baseline".format(name))
+            continue
+
+        change = stats["seconds"] / base["seconds"] - 1 if base["seconds"] else 0
+        memory_change = stats["peak_memory_mb"] - base["peak_memory_mb"]
+        status = "SLOWER" if change > tolerance else "ok"
+        if same_data and (stats.get("output"), stats.get("result")) != (base.get("output"), base.get("result")):
+            status = "OUTPUT CHANGED"
+        if status != "ok":
+            regressed = True
+
+        print("[*] {}: {:.2f}s vs {:.2f}s ({:+.0%}), peak memory {:+.1f} MB - {}".format(
+            name, stats["seconds"], base["seconds"], change, memory_change, status))
+
+    return regressed
+
+
+if __name__ == "__main__":
+    import sys
+
+    parser = argparse.ArgumentParser(description="Time each stage of the pipeline on synthetic data")
+    parser.add_argument("--rows", type=int, default=10000, help="number of synthetic listings (e.g. 10000 to 10000000)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--duplicate-rate", type=float, default=DUPLICATE_RATE)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--crawl-postcodes", type=int, default=CRAWL_POSTCODES, help="number of postcode districts to crawl")
+    parser.add_argument("--workdir", help="directory for the generated files (default: a new temporary directory)")
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES)
+    parser.add_argument("--baseline", default=BASELINE_FILE, help="baseline results to compare against")
+    parser.add_argument("--save-baseline", action="store_true", help="save these results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="slow-down allowed before a stage counts as slower")
+    args = parser.parse_args()
+
+    results = run_benchmark(args.rows, args.seed, args.workdir, args.stages, args.workers, args.duplicate_rate, args.crawl_postcodes)
+    regressed = False
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=2)
+        print("[*] Saved baseline to {}".format(args.baseline))
+    elif os.path.isfile(args.baseline):
+        with open(args.baseline) as baseline_file:
+            regressed = compare_to_baseline(results, json.load(baseline_file), args.tolerance)
+    else:
+        print(json.dumps(results, indent=2))
+
+    sys.exit(1 if regressed else 0)
@@ -1,11 +1,33 @@
 import csv
-import shapefile
-from shapely.geometry import Point, shape
+import io
+import numbers
+import time
+from itertools import islice
+from multiprocessing import Pool
 from tempfile import NamedTemporaryFile
 import shutil
 import os.path
 from constants import FIELDS, load_LHA
-from OSGridConverter import latlong2grid
+from boundary_cache import source_hash, load_cached_boundaries, save_boundaries
+from coordinates import latlong2grid_batch
+from columnar import Snapshot, is_snapshot
+from districts import load_district_boundaries
+from raster import OUTSIDE, STRADDLES, load_raster
+import metrics
+from watermark import file_watermark, resume_offset, load_state, save_state
+
+# Shapely and pyshp are imported where they are used, so that importing this module
+# (e.g. for CHUNK_SIZE, or alongside the analysis) doesn't load them
+
+
+BOUNDARY_FILE = "BRMA/gb-brma"
+
+# Number of rows to read (and convert to grid coordinates) at a time
+CHUNK_SIZE = 10000
+
+# Distance (in metres) within which properties outside every BRMA are assigned the nearest BRMA,
+# when snapping is switched on (it is off by default, see BoundaryAssigner)
+SNAP_TOLERANCE = 500
 
 
 class UnregognisedPropertyLocationException(Exception):
@@ -13,10 +35,24 @@ class UnregognisedPropertyLocationException(Exception):
     pass
 
 
-def load_boundary_files():
-    
+def load_boundary_files(use_cache=True):
+    """Load the BRMA boundaries, keyed by BRMA name
+
+    The cleaned geometries are compiled to an on-disk cache the first time they
+    are loaded, which is rebuilt whenever the shapefile changes
+    """
+
+    if use_cache:
+        key = source_hash(BOUNDARY_FILE)
+        boundaries = load_cached_boundaries(key)
+        if boundaries is not None:
+            return boundaries
+
+    import shapefile
+    from shapely.geometry import shape
+
     boundaries = {}
-    shp = shapefile.Reader("BRMA/gb-brma")
+    shp = shapefile.Reader(BOUNDARY_FILE)
     all_shapes = shp.shapes()
     all_records = shp.records()
 
@@ -27,69 +63,405 @@ def load_boundary_files():
             brma_shape = brma_shape.buffer(0) 
         boundaries[brma_name] = brma_shape
 
+    if use_cache:
+        save_boundaries(boundaries, key)
+
     return boundaries
 
 
-def apply_boundaries(infile, outfile, overwrite=False):
+class BoundaryIndex(object):
+    """Spatial index over the BRMA boundaries
 
-    weekly_LHA = load_LHA()
+    Candidate BRMAs are narrowed down by bounding box (using an STRtree) and only
+    those are tested exactly, against prepared geometries. Candidates are tested
+    in the same order as the shapefile, so the result is the same as checking
+    every boundary in turn.
+    """
 
-    #Cache shapefile boundaries
-    boundaries = load_boundary_files()
+    def __init__(self, boundaries):
+        from shapely.prepared import prep
+        from shapely.strtree import STRtree
 
-    def get_property_boundary(lat, lon, likely_boundary=None):
+        self.names = list(boundaries)
+        self.shapes = [boundaries[name] for name in self.names]
+        self.prepared = {name: prep(boundaries[name]) for name in self.names}
+        self.tree = STRtree(self.shapes)
+        self._positions = {id(brma_shape): i for i, brma_shape in enumerate(self.shapes)}
+        self._order = {name: i for i, name in enumerate(self.names)}
 
-        point = latlong2grid(lat, lon)
-        point = (point.E, point.N)
+    def _position(self, hit):
+        # Shapely 2 returns indices from a query, earlier versions return the geometries
+        if isinstance(hit, numbers.Integral):
+            return int(hit)
+        return self._positions[id(hit)]
 
-        # Check the likely boundary first to save time
-        if likely_boundary and Point(point).within(shape(boundaries[likely_boundary])):
-            return likely_boundary
+    def _candidate_positions(self, point):
+        return sorted(self._position(hit) for hit in self.tree.query(point))
 
-        for boundary in boundaries:
-            if Point(point).within(boundaries[boundary]):
-                return boundary
+    def containing(self, point):
+        """Return the names of every BRMA containing the given point, in file order"""
+        return [self.names[i] for i in self._candidate_positions(point) if self.prepared[self.names[i]].contains(point)]
 
-        raise UnregognisedPropertyLocationException("{},{}".format(lat, lon))
+    def find(self, point, likely_boundaries=(), preferred=None):
+        """Return the name of the BRMA containing the given point, or None if there isn't one
 
-    def file_loop(reader, writer):
-        last_boundary = None
-        
-        writer.writeheader()
-        next(reader)
-        for row in reader:
+        Where BRMAs overlap, `preferred` (the BRMA of the previous property) is returned if
+        it contains the point, and otherwise the first in file order, as when checking the
+        previous property's BRMA and then every boundary in turn. Any likely boundaries
+        given are checked next to save time, then only the candidates before them in the file
+        """
+
+        if preferred in self._order:
+            if self.prepared[preferred].contains(point):
+                return preferred
+
+        match = None
+        checked = set([self._order[preferred]]) if preferred in self._order else set()
+        for i in sorted(set(self._order[boundary] for boundary in likely_boundaries if boundary in self._order)):
+            if self.prepared[self.names[i]].contains(point):
+                match = i
+                break
+            checked.add(i)
+
+        if match == 0:
+            return self.names[0]
+
+        for i in self._candidate_positions(point):
+            if match is not None and i >= match:
+                break
+            if i not in checked and self.prepared[self.names[i]].contains(point):
+                return self.names[i]
+
+        return self.names[match] if match is not None else None
+
+    def nearest(self, point, tolerance):
+        """Return the name of the nearest BRMA within `tolerance` of the given point, and its distance
+
+        Only the BRMAs whose bounding box comes within the tolerance are measured. Returns
+        (None, None) if there isn't one; ties go to the first BRMA in file order
+        """
+
+        from shapely.geometry import box
+
+        x, y = point.x, point.y
+        nearby = box(x - tolerance, y - tolerance, x + tolerance, y + tolerance)
+        nearest, nearest_distance = None, None
+        for i in sorted(self._position(hit) for hit in self.tree.query(nearby)):
+            distance = self.shapes[i].distance(point)
+            if distance <= tolerance and (nearest_distance is None or distance < nearest_distance):
+                nearest, nearest_distance = self.names[i], distance
+
+        return nearest, nearest_distance
+
+
+class BoundaryAssigner(object):
+    """Assigns BRMAs (and affordability) to chunks of properties
+
+    Loads the LHA rates, BRMA geometries and postcode district table once, so a single
+    assigner can be used for a whole file (or by each worker process)
+
+    Unless `use_raster` is False, properties are first looked up in a raster of the BRMAs
+    (see raster.py), and only those in cells on a boundary are checked against the
+    geometries. The raster is built (and cached) the first time it is used
+
+    Properties outside every BRMA (e.g. on the coast, or with inexact coordinates) are left
+    unassigned, unless `snap_tolerance` is set (e.g. to SNAP_TOLERANCE). They are then
+    assigned the nearest BRMA within that many metres, recording how far away it is in the
+    Snap Distance column
+    """
+
+    def __init__(self, overwrite=False, use_raster=True, snap_tolerance=0):
+        self.overwrite = overwrite
+        self.snap_tolerance = snap_tolerance
+        self.snapped = 0
+
+        # While a worker is assigning the start of a chunk (see _assign_chunk), the
+        # properties whose BRMA depends on the one before the chunk, and the BRMAs they are in
+        self.pending = None
+        self.resolving = False
+        self.weekly_LHA = load_LHA()
+
+        #Cache shapefile boundaries
+        self.index = BoundaryIndex(load_boundary_files())
+        key = source_hash(BOUNDARY_FILE)
+
+        # The BRMAs each postcode district is likely to fall in
+        self.district_boundaries = load_district_boundaries(self.index, key)
+
+        self.raster = load_raster(self.index, key) if use_raster else None
+
+        self.last_boundary = None
+
+    def get_property_boundary(self, easting, northing, likely_boundaries=(), preferred=None):
+        from shapely.geometry import Point
+
+        boundary = self.index.find(Point(easting, northing), likely_boundaries, preferred)
+        if boundary:
+            return boundary
+
+        raise UnregognisedPropertyLocationException("{},{}".format(easting, northing))
+
+    def snap_property_boundary(self, easting, northing):
+        """Return the nearest BRMA to a property outside every BRMA, and how far away it is (in metres)"""
+
+        from shapely.geometry import Point
+
+        if self.snap_tolerance > 0:
+            boundary, distance = self.index.nearest(Point(easting, northing), self.snap_tolerance)
+            if boundary:
+                self.snapped += 1
+                return boundary, distance
+
+        raise UnregognisedPropertyLocationException("{},{}".format(easting, northing))
+
+    def assign(self, rows):
+        """Fill in the BRMA, Affordable and Snap Distance columns of a chunk of rows (in place)"""
+
+        from shapely.geometry import Point
+
+        # Convert the coordinates of every property we need to look up in one go
+        positions = [i for i, row in enumerate(rows) if self.overwrite or not row['BRMA']]
+        to_update = [rows[i] for i in positions]
+        eastings, northings = latlong2grid_batch(
+            [float(row["Lat"]) for row in to_update],
+            [float(row["Long"]) for row in to_update]
+        )
+        cells = self.raster.lookup(eastings, northings) if self.raster else [STRADDLES] * len(to_update)
+
+        for position, row, easting, northing, cell in zip(positions, to_update, eastings, northings, cells):
             r = row
 
-            if overwrite or not row['BRMA']:
+            # A property in more than one BRMA takes the BRMA of the property before it, if that's
+            # one of them, so at the start of a chunk these are left for resolve to finish
+            if self.resolving:
+                overlapping = self.index.containing(Point(easting, northing)) if cell == STRADDLES else []
+                if len(overlapping) > 1:
+                    self.pending.append((position, overlapping))
+                else:
+                    self.resolving = False
+
+            try:
+                district = row.get("Postcode (District)")
                 try:
-                    boundary = get_property_boundary(float(row["Lat"]), float(row["Long"]), last_boundary)
-                    r["BRMA"] = boundary
-                    last_boundary = boundary
-                    
-                    if row["Category"] != "N/A":
-
-                        try:
-                            lha = float(weekly_LHA[boundary][row["Category"]])
-                            try:
-                                rent = (float(row["Monthly Rent"]) * 12)/52.1429
-                            except ValueError:
-                                rent = float(row["Weekly Rent"])
-                                
-                            r["Affordable"] = lha >= rent
-                        
-                        #If the BRMA is not defined (shouldn't happen)
-                        except KeyError:
-                            print()                        
-                            print("[!] Error with:" + row["BRMA"])
-                            print("[!] BRMA name inconsistent across files")
-                            print()
+                    if cell == OUTSIDE:
+                        raise UnregognisedPropertyLocationException("{},{}".format(easting, northing))
+                    elif cell != STRADDLES:
+                        boundary = self.raster.name(cell)
+                    else:
+                        # Check the BRMA of the last property (as nearby properties are likely to share
+                        # it), then the BRMAs this property's postcode district usually falls in
+                        boundary = self.get_property_boundary(easting, northing, self.district_boundaries.candidates(district), self.last_boundary)
+                    self.district_boundaries.record(district, boundary)
+                    self.last_boundary = boundary
+                    distance = ""
 
                 except UnregognisedPropertyLocationException:
-                    last_boundary = None
-                    coords = row["Lat"] + "," + row["Long"]
-                    print("[!] No boundary found for coordinates: " + coords)
+                    self.last_boundary = None
+                    boundary, distance = self.snap_property_boundary(easting, northing)
+                    distance = round(distance, 1)
+
+                r["BRMA"] = boundary
+                r["Snap Distance"] = distance
+                self.set_affordable(r)
 
-            writer.writerow(r)
+            except UnregognisedPropertyLocationException:
+                self.last_boundary = None
+                coords = row["Lat"] + "," + row["Long"]
+                print("[!] No boundary found for coordinates: " + coords)
+
+        return rows
+
+    def set_affordable(self, row):
+        """Fill in whether a property is affordable on the LHA rate for its BRMA"""
+
+        if row["Category"] != "N/A":
+
+            try:
+                lha = float(self.weekly_LHA[row["BRMA"]][row["Category"]])
+                try:
+                    rent = (float(row["Monthly Rent"]) * 12)/52.1429
+                except ValueError:
+                    rent = float(row["Weekly Rent"])
+
+                row["Affordable"] = lha >= rent
+
+            #If the BRMA is not defined (shouldn't happen)
+            except KeyError:
+                print()
+                print("[!] Error with:" + row["BRMA"])
+                print("[!] BRMA name inconsistent across files")
+                print()
+
+    def resolve(self, rows, pending, last_boundary):
+        """Finish assigning the properties at the start of a chunk left pending by a worker
+
+        Given the BRMA of the property before the chunk, each is assigned as it would have
+        been in a single process. Returns the BRMA of the last of them (or `last_boundary`)
+        """
+
+        for position, overlapping in pending:
+            row = rows[position]
+            boundary = last_boundary if last_boundary in overlapping else overlapping[0]
+            if row["BRMA"] != boundary:
+                row["BRMA"] = boundary
+                self.set_affordable(row)
+            last_boundary = boundary
+
+        return last_boundary
+
+
+# Each worker process loads its own assigner once, when it starts
+_worker_assigner = None
+
+
+def _init_worker(overwrite, use_raster, snap_tolerance):
+    global _worker_assigner
+    _worker_assigner = BoundaryAssigner(overwrite, use_raster, snap_tolerance)
+
+
+def _assign_chunk(rows):
+    district_boundaries = _worker_assigner.district_boundaries
+    hits, lookups, snapped = district_boundaries.hits, district_boundaries.lookups, _worker_assigner.snapped
+
+    # The BRMA of the property before the chunk isn't known here, so the properties it
+    # could decide are left pending, for the main process to resolve
+    _worker_assigner.last_boundary = None
+    _worker_assigner.pending = []
+    _worker_assigner.resolving = True
+    _worker_assigner.assign(rows)
+    pending, resolving = _worker_assigner.pending, _worker_assigner.resolving
+    _worker_assigner.pending, _worker_assigner.resolving = None, False
+
+    # The BRMA of the last property only counts if it didn't depend on the one before the chunk
+    last_boundary = None if resolving else _worker_assigner.last_boundary
+    return rows, pending, resolving, last_boundary, district_boundaries.hits - hits, district_boundaries.lookups - lookups, _worker_assigner.snapped - snapped
+
+
+def apply_boundaries(infile, outfile, overwrite=False, workers=1, incremental=False, use_raster=True, snap_tolerance=0):
+    """Find the BRMA of every property, and whether it is affordable on the LHA rate for that BRMA
+
+    The properties can be a CSV file or a columnar snapshot
+
+    Optionally, set `workers` to split the file into chunks and assign them in that many
+    processes. Rows are written out in the same order as they were read
+
+    Optionally, set `incremental` to only process the properties added to a CSV file since
+    the last incremental run (e.g. a new day's scrape appended to it). How far the last run
+    got is saved alongside the output file; if the input or output file has been changed
+    other than by appending, or the BRMA or LHA files have changed, every property is
+    processed again
+
+    Properties are looked up in a raster of the BRMAs first, unless `use_raster` is False
+    (see BoundaryAssigner). The results are the same either way
+
+    Optionally, set `snap_tolerance` to assign properties outside every BRMA the nearest
+    BRMA within that many metres (see BoundaryAssigner), and report the number of them
+    """
+
+    start = time.perf_counter()
+    processed = 0
+
+    assigner = BoundaryAssigner(overwrite, use_raster, snap_tolerance)
+    district_boundaries = assigner.district_boundaries
+
+    def counted(rows):
+        nonlocal processed
+        processed += len(rows)
+        metrics.increment("boundaries.rows", len(rows))
+        metrics.increment("boundaries.unmatched", sum(1 for row in rows if not row["BRMA"]))
+        return rows
+
+    def assign_all(chunks):
+        """Assign every chunk, yielding them in order"""
+        if workers <= 1:
+            for rows in chunks:
+                yield counted(assigner.assign(rows))
+            return
+
+        # The compiled geometries and district table have been cached by the assigner
+        # above, so each worker only has to load them
+        with Pool(workers, initializer=_init_worker, initargs=(overwrite, use_raster, snap_tolerance)) as pool:
+            last_boundary = None
+            for rows, pending, resolving, chunk_last_boundary, hits, lookups, snapped in pool.imap(_assign_chunk, chunks):
+                last_boundary = assigner.resolve(rows, pending, last_boundary)
+                if not resolving:
+                    last_boundary = chunk_last_boundary
+                district_boundaries.hits += hits
+                district_boundaries.lookups += lookups
+                assigner.snapped += snapped
+                yield counted(rows)
+
+    def report():
+        seconds = time.perf_counter() - start
+        metrics.gauge("boundaries.rows_per_second", processed / seconds if seconds else 0)
+        metrics.increment("boundaries.snapped", assigner.snapped)
+        if assigner.snapped:
+            print("[*] Snapped {} properties to the nearest BRMA (within {}m)".format(assigner.snapped, snap_tolerance))
+        if district_boundaries.hit_rate is not None:
+            print("[*] Postcode district table hit rate: {:.1%}".format(district_boundaries.hit_rate))
+            metrics.gauge("boundaries.district_hit_rate", district_boundaries.hit_rate)
+
+    def read_chunks(reader):
+        while True:
+            rows = list(islice(reader, CHUNK_SIZE))
+            if not rows:
+                break
+            yield rows
+
+    def file_loop(reader, writer):
+        writer.writeheader()
+        next(reader)
+        for rows in assign_all(read_chunks(reader)):
+            writer.writerows(rows)
+
+    # Columnar snapshots only need the columns used here to be read, and the
+    # BRMA and Affordable columns to be rewritten
+    if is_snapshot(infile):
+        if infile != outfile:
+            if os.path.isdir(outfile):
+                shutil.rmtree(outfile)
+            shutil.copytree(infile, outfile)
+
+        snapshot = Snapshot(outfile)
+        columns = ["Lat", "Long", "Postcode (District)", "BRMA", "Category", "Weekly Rent", "Monthly Rent", "Affordable"]
+        if snapshot.has_column("Snap Distance"):
+            columns.append("Snap Distance")
+        rows = list(snapshot.rows(columns))
+        chunks = (rows[start:start + CHUNK_SIZE] for start in range(0, len(rows), CHUNK_SIZE))
+        rows = [row for chunk in assign_all(chunks) for row in chunk]
+
+        snapshot.write_category_column("BRMA", [row["BRMA"] for row in rows])
+        snapshot.write_category_column("Affordable", [str(row["Affordable"]) for row in rows])
+        snapshot.write_float_column("Snap Distance", [row.get("Snap Distance") for row in rows])
+        report()
+        return
+
+    state_file = outfile + ".boundaries-state"
+    if incremental:
+        sources = {"BRMA": source_hash(BOUNDARY_FILE), "LHA": file_watermark("weekly-lha.csv"), "snap_tolerance": snap_tolerance}
+        state = load_state(state_file)
+        input_offset = resume_offset(state.get("input"), infile)
+        output_offset = resume_offset(state.get("output"), outfile)
+
+        if state.get("sources") == sources and input_offset is not None and output_offset is not None \
+                and (infile == outfile or output_offset == os.path.getsize(outfile)):
+            with open(infile, 'rb') as rawfile:
+                rawfile.seek(input_offset)
+                reader = csv.DictReader(io.TextIOWrapper(rawfile, newline=''), fieldnames=FIELDS)
+                rows = [row for chunk in assign_all(read_chunks(reader)) for row in chunk]
+            print("[*] Assigned boundaries to {} new properties".format(len(rows)))
+
+            # Replace (or append) just the new rows
+            with open(outfile, 'r+b') as rawfile:
+                rawfile.seek(output_offset)
+                rawfile.truncate()
+                with io.TextIOWrapper(rawfile, newline='') as outcsv:
+                    writer = csv.DictWriter(outcsv, fieldnames=FIELDS)
+                    writer.writerows(rows)
+
+            save_state(state_file, {"sources": sources, "input": file_watermark(infile), "output": file_watermark(outfile)})
+            report()
+            return
 
     if infile == outfile:
         tempfile = NamedTemporaryFile(mode='w', delete=False, newline='')
@@ -104,3 +476,11 @@ def apply_boundaries(infile, outfile, overwrite=False):
             reader = csv.DictReader(csvfile, fieldnames=FIELDS)
             writer = csv.DictWriter(outcsv, fieldnames=FIELDS)
             file_loop(reader, writer)
+
+    if incremental:
+        save_state(state_file, {"sources": sources, "input": file_watermark(infile), "output": file_watermark(outfile)})
+    elif os.path.isfile(state_file):
+        # The output has been rewritten without updating the state, so it's no longer valid
+        os.remove(state_file)
+
+    report()
@@ -0,0 +1,85 @@
+import hashlib
+import json
+import mmap
+import os
+import shutil
+import numpy as np
+from tempfile import mkdtemp
+
+
+# Directory holding compiled copies of the BRMA geometries, one sub-directory per
+# version of the source shapefile
+CACHE_DIR = "BRMA/cache"
+
+
+def source_hash(shapefile_path):
+    """Return a hash of the .shp and .dbf files that make up the given shapefile"""
+    sha = hashlib.sha256()
+    for extension in (".shp", ".dbf"):
+        with open(shapefile_path + extension, 'rb') as source:
+            for block in iter(lambda: source.read(1 << 20), b''):
+                sha.update(block)
+    return sha.hexdigest()
+
+
+def save_boundaries(boundaries, key, cache_dir=CACHE_DIR):
+    """Write the given (cleaned) boundaries to the cache under the given key
+
+    Geometries are stored as WKB, one after the other in a single file, alongside
+    their offsets into that file and the BRMA names (in file order)
+    """
+
+    from shapely import wkb
+
+    os.makedirs(cache_dir, exist_ok=True)
+
+    # Build the cache in a temporary directory and move it into place once it
+    # is complete, so a crash can't leave a half-written cache behind
+    build_dir = mkdtemp(dir=cache_dir)
+    offsets = [0]
+    with open(os.path.join(build_dir, "shapes.wkb"), 'wb') as shapes_file:
+        for name in boundaries:
+            data = wkb.dumps(boundaries[name])
+            shapes_file.write(data)
+            offsets.append(offsets[-1] + len(data))
+
+    np.save(os.path.join(build_dir, "offsets.npy"), np.array(offsets, dtype=np.int64))
+    with open(os.path.join(build_dir, "names.json"), 'w') as names_file:
+        json.dump(list(boundaries), names_file)
+
+    target = os.path.join(cache_dir, key)
+    if os.path.isdir(target):
+        shutil.rmtree(target)
+    os.rename(build_dir, target)
+
+    # Remove compiled copies of previous versions of the shapefile
+    for entry in os.listdir(cache_dir):
+        if entry != key:
+            shutil.rmtree(os.path.join(cache_dir, entry), ignore_errors=True)
+
+
+def cache_file(key, filename, cache_dir=CACHE_DIR):
+    """Return the path of another file derived from (and cached alongside) the boundaries under the given key"""
+    return os.path.join(cache_dir, key, filename)
+
+
+def load_cached_boundaries(key, cache_dir=CACHE_DIR):
+    """Return the boundaries cached under the given key, or None if there aren't any"""
+
+    target = os.path.join(cache_dir, key)
+    try:
+        with open(os.path.join(target, "names.json")) as names_file:
+            names = json.load(names_file)
+        offsets = np.load(os.path.join(target, "offsets.npy"), mmap_mode='r')
+        shapes_file = open(os.path.join(target, "shapes.wkb"), 'rb')
+    except (OSError, ValueError):
+        return None
+
+    from shapely import wkb
+
+    boundaries = {}
+    with shapes_file, mmap.mmap(shapes_file.fileno(), 0, access=mmap.ACCESS_READ) as shapes:
+        for i, name in enumerate(names):
+            boundaries[name] = wkb.loads(shapes[int(offsets[i]):int(offsets[i+1])])
+
+    return boundaries
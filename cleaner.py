@@ -1,53 +1,288 @@
 import csv
-from tempfile import NamedTemporaryFile
+import re
+import zlib
+import hashlib
+import numpy as np
+from tempfile import NamedTemporaryFile, TemporaryDirectory
 import shutil
 import os.path
 from constants import FIELDS
+import metrics
 
-def remove_duplicates(infile, outfile):
+
+# Number of partitions when removing duplicates out of memory, and the number of hashes
+# (8 bytes each, across every partition) held in memory before they are written out
+PARTITIONS = 64
+BUFFERED_ROWS = 1000000
+
+# Near-duplicate detection: listings are compared with others within LOCATION_PRECISION
+# decimal places of latitude/longitude (about 100m), with the same number of bedrooms
+# and a weekly rent within RENT_TOLERANCE, and are near-duplicates if the estimated
+# similarity of their title and summary is at least SIMILARITY_THRESHOLD
+LOCATION_PRECISION = 3
+RENT_TOLERANCE = 1.0
+SIMILARITY_THRESHOLD = 0.8
+SHINGLE_SIZE = 4
+MINHASH_PERMUTATIONS = 64
+MINHASH_PRIME = (1 << 31) - 1
+
+_random = np.random.RandomState(1)
+MINHASH_A = _random.randint(1, MINHASH_PRIME, size=(MINHASH_PERMUTATIONS, 1)).astype(np.uint64)
+MINHASH_B = _random.randint(0, MINHASH_PRIME, size=(MINHASH_PERMUTATIONS, 1)).astype(np.uint64)
+
+
+def url_key(row):
+    """Return the part of a listing's URL that identifies the property it is for"""
+    return row["Source URL"].split("title")[0]
+
+
+def url_hash(row):
+    """Return a fixed-size (64-bit) hash of a listing's url_key"""
+    return int.from_bytes(hashlib.blake2b(url_key(row).encode(), digest_size=8).digest(), 'little')
+
+
+def remove_duplicates(infile, outfile, external=False):
     """Attempt to remove all duplicates from a given file
 
     Note: these are not (only) duplicates that are identical, it should also include
     different listings for the same property (while ignoring listings for different
     properties in the same building)
+
+    Rows are streamed from one file to the other, and only a 64-bit hash of each listing
+    seen so far is kept in memory. For files with too many listings even for that, set
+    `external` to find the duplicates by partitioning the hashes on disk instead.
+
+    Returns the number of duplicates removed
     """
 
+    def log_postcode(row, current_postcode):
+        postcode = row["Postcode (District)"]
+        if current_postcode != postcode:
+            print("[*] Now removing duplicates for " + postcode)
+        return postcode
+
     def file_loop(reader, writer):
         current_postcode = None
         seen = set()
+        dropped = 0
 
         next(reader)
-        properties_to_check = list(reader)
-
         writer.writeheader()
 
-        while properties_to_check:
+        for row in reader:
+            current_postcode = log_postcode(row, current_postcode)
 
-            row = properties_to_check.pop(0)
+            key = url_hash(row)
+            if key not in seen:
+                seen.add(key)
+                writer.writerow(row)
+            else:
+                dropped += 1
 
-            postcode = row["Postcode (District)"]
+        return dropped
 
-            if current_postcode != postcode:
-                current_postcode = postcode
-                print("[*] Now removing duplicates for " + current_postcode)
+    def external_file_loop(reader, writer):
+        with TemporaryDirectory() as workdir:
+            drop, _ = find_duplicate_rows(infile, workdir)
 
-            url_start = row["Source URL"].split("title")[0]
-            if url_start not in seen:
-                seen.add(url_start)
-                writer.writerow(row)
-            else:
-                continue
+            current_postcode = None
+            next(reader)
+            writer.writeheader()
+
+            for i, row in enumerate(reader):
+                current_postcode = log_postcode(row, current_postcode)
+                if not drop[i]:
+                    writer.writerow(row)
+
+            dropped = int(np.count_nonzero(drop))
+            del drop
+        return dropped
+
+    dropped = rewrite_file(infile, outfile, external_file_loop if external else file_loop)
+
+    print("[*] Removed {} duplicates".format(dropped))
+    metrics.increment("cleaner.duplicates_dropped", dropped)
+    return dropped
+
+
+def rewrite_file(infile, outfile, file_loop):
+    """Run file_loop(reader, writer) from infile to outfile (which can be the same file), returning its result"""
 
     if infile == outfile:
         tempfile = NamedTemporaryFile(mode='w', delete=False, newline='')
         with open(infile, 'r', newline='') as csvfile, tempfile:
             reader = csv.DictReader(csvfile, fieldnames=FIELDS)
             writer = csv.DictWriter(tempfile, fieldnames=FIELDS)
-            file_loop(reader, writer)
+            result = file_loop(reader, writer)
         shutil.move(tempfile.name, infile)
 
     else:
         with open(infile, 'r', newline='') as csvfile, open(outfile, 'w', newline='') as outcsv:
             reader = csv.DictReader(csvfile, fieldnames=FIELDS)
             writer = csv.DictWriter(outcsv, fieldnames=FIELDS)
-            file_loop(reader, writer)
+            result = file_loop(reader, writer)
+
+    return result
+
+
+def find_duplicate_rows(infile, workdir, partitions=PARTITIONS, buffered_rows=BUFFERED_ROWS):
+    """Find which rows of a file are duplicates of an earlier row, without holding every hash in memory
+
+    The (hash, row number) of every row is written out to one of several partition files
+    by hash, then each partition is sorted in turn to find every repeat of a hash after
+    its first row. Hashes are collected in a fixed-size array of `buffered_rows` and written
+    out to the partitions whenever it fills up. Returns a (memory-mapped) boolean array of
+    the rows to drop, and the number of rows
+    """
+
+    record = np.dtype([("hash", "<u8"), ("row", "<u8")])
+    paths = [os.path.join(workdir, "partition-{}.bin".format(p)) for p in range(partitions)]
+    files = [open(path, 'wb') for path in paths]
+    hashes = np.empty(buffered_rows, dtype=np.uint64)
+
+    def flush(first_row, count):
+        # The buffer holds consecutive rows, so only their hashes need to be kept
+        buffered = np.empty(count, dtype=record)
+        buffered["hash"] = hashes[:count]
+        buffered["row"] = np.arange(first_row, first_row + count, dtype=np.uint64)
+        by_partition = buffered["hash"] % np.uint64(partitions)
+        buffered = buffered[np.argsort(by_partition, kind='stable')]
+        ends = np.cumsum(np.bincount(by_partition.astype(np.int64), minlength=partitions))
+        for p, (start, end) in enumerate(zip(np.concatenate([[0], ends[:-1]]), ends)):
+            buffered[start:end].tofile(files[p])
+
+    rows = 0
+    count = 0
+    try:
+        with open(infile, 'r', newline='') as csvfile:
+            reader = csv.DictReader(csvfile, fieldnames=FIELDS)
+            next(reader)
+            for i, row in enumerate(reader):
+                hashes[count] = url_hash(row)
+                count += 1
+                if count == buffered_rows:
+                    flush(i + 1 - count, count)
+                    count = 0
+                rows = i + 1
+
+        flush(rows - count, count)
+    finally:
+        for partition_file in files:
+            partition_file.close()
+
+    drop = np.memmap(os.path.join(workdir, "drop.bin"), dtype=bool, mode='w+', shape=(max(rows, 1),))
+    for path in paths:
+        partition = np.fromfile(path, dtype=record)
+        if len(partition):
+            partition = partition[np.lexsort((partition["row"], partition["hash"]))]
+            repeat = np.empty(len(partition), dtype=bool)
+            repeat[0] = False
+            repeat[1:] = partition["hash"][1:] == partition["hash"][:-1]
+            drop[partition["row"][repeat]] = True
+        os.remove(path)
+
+    return drop, rows
+
+
+def minhash(text):
+    """Return the MinHash signature of the character shingles of a piece of text"""
+
+    text = re.sub(r'\W+', ' ', text.lower()).strip()
+    shingles = {text[i:i + SHINGLE_SIZE] for i in range(max(len(text) - SHINGLE_SIZE + 1, 1))}
+    hashes = np.array([zlib.crc32(shingle.encode()) for shingle in shingles], dtype=np.uint64)
+
+    return ((MINHASH_A * hashes + MINHASH_B) % MINHASH_PRIME).min(axis=1).astype(np.uint32)
+
+
+def similarity(signature, other):
+    """Estimate the Jaccard similarity of the texts two MinHash signatures came from"""
+    return np.count_nonzero(signature == other) / len(signature)
+
+
+class NearDuplicateIndex(object):
+    """Index of listings seen so far, for finding other listings of the same property
+
+    Listings are bucketed by rounded location, number of bedrooms and weekly rent, so
+    each new listing is only compared with those in the neighbouring buckets, rather
+    than with every listing seen so far
+    """
+
+    def __init__(self, precision=LOCATION_PRECISION, rent_tolerance=RENT_TOLERANCE, threshold=SIMILARITY_THRESHOLD):
+        self.precision = precision
+        self.rent_tolerance = rent_tolerance
+        self.threshold = threshold
+        self.step = 10 ** -precision
+        self.buckets = {}
+
+    def _bucket(self, lat, lon, bedrooms, rent):
+        return (round(lat, self.precision), round(lon, self.precision), bedrooms, int(rent // self.rent_tolerance))
+
+    def _neighbours(self, lat, lon, bedrooms, rent):
+        lat_bucket, lon_bucket, bedrooms, rent_bucket = self._bucket(lat, lon, bedrooms, rent)
+        for d_lat in (-1, 0, 1):
+            for d_lon in (-1, 0, 1):
+                for d_rent in (-1, 0, 1):
+                    key = (round(lat_bucket + d_lat * self.step, self.precision), round(lon_bucket + d_lon * self.step, self.precision), bedrooms, rent_bucket + d_rent)
+                    for entry in self.buckets.get(key, ()):
+                        yield entry
+
+    def add(self, lat, lon, bedrooms, rent, text):
+        """Add a listing to the index, unless it is a near-duplicate of one already there
+
+        Returns True if the listing was added, or False if it is a near-duplicate
+        """
+
+        signature = minhash(text)
+
+        for other_lat, other_lon, other_rent, other_signature in self._neighbours(lat, lon, bedrooms, rent):
+            if (abs(other_lat - lat) <= self.step and abs(other_lon - lon) <= self.step
+                    and abs(other_rent - rent) <= self.rent_tolerance
+                    and similarity(signature, other_signature) >= self.threshold):
+                return False
+
+        self.buckets.setdefault(self._bucket(lat, lon, bedrooms, rent), []).append((lat, lon, rent, signature))
+        return True
+
+
+def remove_near_duplicates(infile, outfile, threshold=SIMILARITY_THRESHOLD):
+    """Remove listings for the same property that come from different URLs (e.g. syndicated by different sites)
+
+    Two listings are treated as the same property if they are within about 100m of each other,
+    have the same number of bedrooms and (nearly) the same rent, and their titles and summaries
+    are similar. The first listing found is kept. This should be run after remove_duplicates
+
+    Returns the number of listings removed
+    """
+
+    def file_loop(reader, writer):
+        index = NearDuplicateIndex(threshold=threshold)
+        dropped = 0
+
+        next(reader)
+        writer.writeheader()
+
+        for row in reader:
+            try:
+                lat, lon = float(row["Lat"]), float(row["Long"])
+                bedrooms = int(row["Bedrooms"])
+                try:
+                    rent = (float(row["Monthly Rent"]) * 12)/52.1429
+                except ValueError:
+                    rent = float(row["Weekly Rent"])
+            # Keep anything we can't compare
+            except ValueError:
+                writer.writerow(row)
+                continue
+
+            if index.add(lat, lon, bedrooms, rent, row["Title"] + " " + row["Listing Summary"]):
+                writer.writerow(row)
+            else:
+                dropped += 1
+
+        return dropped
+
+    dropped = rewrite_file(infile, outfile, file_loop)
+
+    print("[*] Removed {} near-duplicates".format(dropped))
+    metrics.increment("cleaner.near_duplicates_dropped", dropped)
+    return dropped
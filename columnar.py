@@ -0,0 +1,259 @@
+import csv
+import json
+import os
+import re
+import shutil
+import numpy as np
+from array import array
+from constants import FIELDS
+
+
+# How each column is stored in a snapshot:
+#   float    - float64 array, NaN where the CSV value was empty
+#   int      - int32 array, -1 where the CSV value was empty
+#   category - int32 array of codes into a dictionary of the distinct values
+#   text     - UTF-8 bytes of every value back to back, with an int64 array of offsets
+COLUMN_TYPES = {
+    "Scraped Date": "text",
+    "Listed Date": "category",
+    "Lat": "float",
+    "Long": "float",
+    "Title": "text",
+    "Postcode (District)": "category",
+    "BRMA": "category",
+    "Bedrooms": "int",
+    "Category": "category",
+    "Weekly Rent": "float",
+    "Monthly Rent": "float",
+    "Affordable": "category",
+    "Primary Listing": "category",
+    "Secondary Listing": "category",
+    "Source URL": "text",
+    "Image URL": "text",
+    "Contact Email": "text",
+    "Contact Phone": "text",
+    "Listing Summary": "text",
+    "Listing Text": "text",
+    "Snap Distance": "float"
+}
+
+FORMAT_VERSION = 2
+
+# Columns added to FIELDS since the first version, with the version that added them. Snapshots
+# made before a column was added are read as if every value in it were empty
+ADDED_COLUMNS = {"Snap Distance": 2}
+
+
+def _slug(name):
+    return re.sub(r'[^a-z0-9]+', '_', name.lower()).strip('_')
+
+
+def _format_number(value):
+    if np.isnan(value):
+        return ""
+    if value == int(value):
+        return str(int(value))
+    return repr(float(value))
+
+
+def is_snapshot(path):
+    """Whether the given path is a columnar snapshot (rather than, e.g., a CSV file)"""
+    return os.path.isfile(os.path.join(path, "meta.json"))
+
+
+class Snapshot(object):
+    """A columnar snapshot of properties, stored as a directory with one file (or two) per column
+
+    Columns are memory-mapped when they are first used, so a stage only reads the columns
+    it needs. Numeric columns are NumPy arrays; category columns are arrays of codes into
+    a list of the distinct values (see `categories`)
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as meta_file:
+            self.meta = json.load(meta_file)
+        self.columns = {}
+
+        if self.meta["version"] > FORMAT_VERSION:
+            raise ValueError("Snapshot {} was made by a newer version (format {})".format(path, self.meta["version"]))
+
+    def __len__(self):
+        return self.meta["rows"]
+
+    def _file(self, name, suffix):
+        return os.path.join(self.path, _slug(name) + suffix)
+
+    def has_column(self, name):
+        return name in self.meta["columns"]
+
+    def _missing(self, name):
+        # Whether a column is one the snapshot was made before (see ADDED_COLUMNS)
+        return name in ADDED_COLUMNS and not self.has_column(name)
+
+    def column_type(self, name):
+        if self._missing(name):
+            return COLUMN_TYPES[name]
+        return self.meta["columns"][name]["type"]
+
+    def column(self, name):
+        """Return the (memory-mapped) array for a column; the codes for category columns"""
+        try:
+            return self.columns[name]
+        except KeyError:
+            pass
+
+        if self.column_type(name) == "text":
+            raise ValueError("Text column {} has no array, use values() instead".format(name))
+
+        if self._missing(name):
+            # Only float columns have been added, which are NaN where empty
+            column = self.columns[name] = np.full(len(self), np.nan)
+            return column
+
+        column = self.columns[name] = np.load(self._file(name, ".npy"), mmap_mode='r')
+        return column
+
+    def categories(self, name):
+        """Return the distinct values of a category column, indexed by code"""
+        return self.meta["columns"][name]["categories"]
+
+    def lower_codes(self, name):
+        """Return the distinct lower case values of a category column, and the code of each row into them"""
+        lowered = [value.lower() for value in self.categories(name)]
+        names = sorted(set(lowered))
+        lookup = np.array([names.index(value) for value in lowered], dtype=np.int64)
+        codes = np.asarray(self.column(name))
+        return names, lookup[codes] if len(lookup) else np.zeros(len(codes), dtype=np.int64)
+
+    def values(self, name):
+        """Return the values of a column as a list of strings (as they would appear in a CSV)"""
+        if self._missing(name):
+            return [""] * len(self)
+
+        column_type = self.column_type(name)
+
+        if column_type == "category":
+            categories = self.categories(name)
+            return [categories[code] for code in self.column(name)]
+
+        if column_type == "text":
+            offsets = np.load(self._file(name, ".offsets.npy"), mmap_mode='r').tolist()
+            with open(self._file(name, ".bytes"), 'rb') as text_file:
+                data = text_file.read()
+            return [data[offsets[i]:offsets[i+1]].decode() for i in range(len(self))]
+
+        if column_type == "int":
+            return ["" if value < 0 else str(value) for value in self.column(name)]
+
+        return [_format_number(value) for value in self.column(name)]
+
+    def rows(self, columns=FIELDS):
+        """Iterate over the rows of the snapshot as dictionaries (like csv.DictReader)"""
+        values = [self.values(name) for name in columns]
+        for row in zip(*values):
+            yield dict(zip(columns, row))
+
+    def write_category_column(self, name, values):
+        """Replace the values of a category column"""
+        categories = {}
+        codes = np.fromiter((categories.setdefault(value, len(categories)) for value in values), dtype=np.int32, count=len(self))
+
+        self.columns.pop(name, None)
+        np.save(self._file(name, ".npy"), codes)
+        self.meta["columns"][name]["categories"] = list(categories)
+        self._save_meta()
+
+    def write_float_column(self, name, values):
+        """Replace the values of a float column (adding it if the snapshot doesn't have it), empty values being NaN"""
+        column = np.fromiter((float(value) if value not in ("", None) else np.nan for value in values), dtype=np.float64, count=len(self))
+
+        self.columns.pop(name, None)
+        np.save(self._file(name, ".npy"), column)
+        self.meta["columns"][name] = {"type": "float"}
+        self._save_meta()
+
+    def _save_meta(self):
+        with open(os.path.join(self.path, "meta.json"), 'w') as meta_file:
+            json.dump(self.meta, meta_file)
+
+
+def import_csv(infile, path):
+    """Convert a CSV file of properties (in the format of FIELDS) to a columnar snapshot at the given path"""
+
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.makedirs(path)
+
+    numbers = {}
+    codes = {}
+    categories = {}
+    offsets = {}
+    text_files = {}
+
+    for name in FIELDS:
+        column_type = COLUMN_TYPES[name]
+        if column_type == "float":
+            numbers[name] = array('d')
+        elif column_type == "int":
+            numbers[name] = array('i')
+        elif column_type == "category":
+            codes[name] = array('i')
+            categories[name] = {}
+        else:
+            offsets[name] = array('q', [0])
+            text_files[name] = open(os.path.join(path, _slug(name) + ".bytes"), 'wb')
+
+    rows = 0
+    try:
+        with open(infile, 'r', newline='') as csvfile:
+            reader = csv.DictReader(csvfile, fieldnames=FIELDS)
+            next(reader)
+            for row in reader:
+                rows += 1
+                for name in FIELDS:
+                    value = row[name] or ""
+                    column_type = COLUMN_TYPES[name]
+                    if column_type == "float":
+                        numbers[name].append(float(value) if value else np.nan)
+                    elif column_type == "int":
+                        numbers[name].append(int(value) if value else -1)
+                    elif column_type == "category":
+                        codes[name].append(categories[name].setdefault(value, len(categories[name])))
+                    else:
+                        data = value.encode()
+                        text_files[name].write(data)
+                        offsets[name].append(offsets[name][-1] + len(data))
+    finally:
+        for text_file in text_files.values():
+            text_file.close()
+
+    meta = {"version": FORMAT_VERSION, "rows": rows, "columns": {}}
+    for name in FIELDS:
+        column_type = COLUMN_TYPES[name]
+        meta["columns"][name] = {"type": column_type}
+        if column_type == "float":
+            np.save(os.path.join(path, _slug(name) + ".npy"), np.array(numbers[name], dtype=np.float64))
+        elif column_type == "int":
+            np.save(os.path.join(path, _slug(name) + ".npy"), np.array(numbers[name], dtype=np.int32))
+        elif column_type == "category":
+            np.save(os.path.join(path, _slug(name) + ".npy"), np.array(codes[name], dtype=np.int32))
+            meta["columns"][name]["categories"] = list(categories[name])
+        else:
+            np.save(os.path.join(path, _slug(name) + ".offsets.npy"), np.array(offsets[name], dtype=np.int64))
+
+    # Write the metadata last, so an unfinished import isn't mistaken for a snapshot
+    with open(os.path.join(path, "meta.json"), 'w') as meta_file:
+        json.dump(meta, meta_file)
+
+    return Snapshot(path)
+
+
+def export_csv(path, outfile):
+    """Convert a columnar snapshot back to a CSV file of properties"""
+
+    snapshot = Snapshot(path)
+    with open(outfile, 'w', newline='') as outcsv:
+        writer = csv.DictWriter(outcsv, fieldnames=FIELDS)
+        writer.writeheader()
+        writer.writerows(snapshot.rows())
@@ -20,7 +20,8 @@ FIELDS = [
     "Contact Email",
     "Contact Phone",
     "Listing Summary",
-    "Listing Text"
+    "Listing Text",
+    "Snap Distance"
 ]
 
 
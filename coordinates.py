@@ -0,0 +1,143 @@
+import numpy as np
+
+# The constants and formulae below mirror those used by OSGridConverter.latlong2grid,
+# so that converting a whole file at once gives the same grid references as
+# converting each property in turn
+
+# WGS84 ellipsoid (a, b, f)
+WGS84 = (6378137, 6356752.31425, 1/298.257223563)
+
+# Airy 1830 ellipsoid (a, b, f), used by OSGB36
+AIRY1830 = (6377563.396, 6356256.909, 1/299.3249646)
+
+# Helmert transform from WGS84 to OSGB36: translation (m), rotation (arcseconds), scale (ppm)
+HELMERT_T = (-446.448, 125.157, -542.060)
+HELMERT_R = (-0.1502, -0.2470, -0.8421)
+HELMERT_S = 20.4894
+
+# National Grid projection
+F0 = 0.9996012717
+PHI0 = np.radians(49)
+L0 = np.radians(-2)
+N0 = -100000
+E0 = 400000
+
+
+def _to_cartesian(phi, l, ellipsoid):
+    a, b, f = ellipsoid
+    s = np.sin(phi)
+    c = np.cos(phi)
+    e_sq = 2*f - f*f
+    nu = a/np.sqrt(1.0 - e_sq*s*s)
+    return nu*c*np.cos(l), nu*c*np.sin(l), nu*(1 - e_sq)*s
+
+
+def _helmert(x, y, z):
+    tx, ty, tz = HELMERT_T
+    rx, ry, rz = [np.radians(r/3600.0) for r in HELMERT_R]
+    s = 1.0 + HELMERT_S/1.0e6
+    return (
+        tx + (s*x - rz*y + ry*z),
+        ty + (rz*x + s*y - rx*z),
+        tz + (-ry*x + rx*y + s*z)
+    )
+
+
+def _to_latlong(x, y, z, ellipsoid):
+    a, b, f = ellipsoid
+    e1 = 2*f - f*f
+    e2 = e1/(1 - e1)
+
+    p = np.sqrt(x*x + y*y)
+    # OSGridConverter uses the squared distance from the centre here
+    r = p*p + z*z
+
+    t = (1 + e2*b/r)*b*z/(a*p)
+    s = t/np.sqrt(1 + t*t)
+    c = s/t
+
+    phi = np.arctan2(z + e2*b*s*s*s, p - e1*a*c*c*c)
+    phi = np.where(np.isnan(c), 0, phi)
+    l = np.arctan2(y, x)
+
+    return np.degrees(phi), np.degrees(l)
+
+
+def _meridional(phi):
+    a, b, f = AIRY1830
+    n = (a - b)/(a + b)
+    nn = n**2
+    nnn = n**3
+    m = [1.0 + n + 5.0*(nn + nnn)/4.0,
+         3.0*(n + nn) + 21.0*nnn/8.0,
+         15.0*(nn + nnn)/8.0,
+         35.0*nnn/24.0]
+
+    p_minus = phi - PHI0
+    p_plus = phi + PHI0
+    return (m[0]*p_minus
+            + m[1]*(-np.sin(p_minus)*np.cos(p_plus))
+            + m[2]*(np.sin(2*p_minus)*np.cos(2*p_plus))
+            + m[3]*(-np.sin(3*p_minus)*np.cos(3*p_plus))) * b*F0
+
+
+def _to_grid(phi, l):
+    a, b, f = AIRY1830
+    e2 = 2*f - f*f
+    n = (a - b)/(a + b)
+    a_f0 = a*F0
+
+    c = np.cos(phi)
+    s = np.sin(phi)
+    t2 = np.tan(phi)**2
+    t4 = t2**2
+
+    w = 1.0 - e2*s**2
+    nu = a_f0/np.sqrt(w)
+    rho = a_f0*(1 - e2)*w**-1.5
+    eta1 = nu/rho
+    eta2 = eta1 - 1.0
+
+    i = _meridional(phi) + N0
+    ii = nu*c*s/2.0
+    iii = nu*c**3*s*(5 - t2 + 9*n**2)/24.0
+    iiia = nu*c**5*s*(61 - 58*t2 + t4)/720.0
+    iv = nu*c
+    v = nu*c**3*(eta1 - t2)/6.0
+    vi = nu*c**5*(5 - 18*t2 + t4 + 14*eta2 - 58*t2*eta2)/120.0
+
+    dl = l - L0
+    northing = i + ii*dl**2 + iii*dl**4 + iiia*dl**6
+    easting = E0 + iv*dl + v*dl**3 + vi*dl**5
+    return easting, northing
+
+
+def latlong2grid_batch(latitudes, longitudes):
+    """Convert arrays of WGS84 latitudes and longitudes to OSGB36 eastings and northings
+
+    Equivalent to calling OSGridConverter.latlong2grid for each point, and returns
+    two integer arrays (of eastings and northings respectively)
+    """
+
+    phi = np.radians(np.asarray(latitudes, dtype=float))
+    l = np.radians(np.asarray(longitudes, dtype=float))
+
+    x, y, z = _helmert(*_to_cartesian(phi, l, WGS84))
+    latitudes, longitudes = _to_latlong(x, y, z, AIRY1830)
+    easting, northing = _to_grid(np.radians(latitudes), np.radians(longitudes))
+
+    return np.floor(easting).astype(np.int64), np.floor(northing).astype(np.int64)
+
+
+def check_against_latlong2grid(latitudes, longitudes):
+    """Compare latlong2grid_batch against OSGridConverter.latlong2grid, and return the points that differ"""
+    from OSGridConverter import latlong2grid
+
+    eastings, northings = latlong2grid_batch(latitudes, longitudes)
+    mismatches = []
+    for lat, lon, easting, northing in zip(latitudes, longitudes, eastings, northings):
+        point = latlong2grid(lat, lon)
+        if (point.E, point.N) != (easting, northing):
+            mismatches.append((lat, lon, (point.E, point.N), (int(easting), int(northing))))
+    return mismatches
+
@@ -0,0 +1,120 @@
+import csv
+import math
+import os
+from collections import Counter
+from boundary_cache import cache_file
+
+
+DISTRICTS_FILE = "postcode-districts.csv"
+
+# Number of candidate BRMAs kept for each district
+MAX_CANDIDATES = 4
+
+# Number of points sampled around each district's centre, as well as the centre itself
+# and the centres of its nearby districts
+SAMPLE_DIRECTIONS = 8
+
+
+def load_districts(infile=DISTRICTS_FILE):
+    """Load the postcode districts, keyed by postcode"""
+    with open(infile) as csvfile:
+        reader = csv.DictReader(csvfile)
+        return {row["Postcode"]: row for row in reader}
+
+
+class DistrictBoundaries(object):
+    """Table of the BRMAs each postcode district is likely to fall in, used to seed boundary lookups
+
+    Keeps count of how often a lookup found its BRMA among the district's candidates
+    """
+
+    def __init__(self, table):
+        self.table = table
+        self.lookups = 0
+        self.hits = 0
+
+    def candidates(self, district):
+        """Return the candidate BRMAs for a district, most likely first"""
+        return self.table.get(district, [])
+
+    def record(self, district, boundary):
+        """Record the BRMA a property in the given district was found in"""
+        self.lookups += 1
+        if boundary in self.table.get(district, ()):
+            self.hits += 1
+
+    @property
+    def hit_rate(self):
+        return self.hits / self.lookups if self.lookups else None
+
+
+def precompute_district_boundaries(index, infile=DISTRICTS_FILE):
+    """Work out the candidate BRMAs for every postcode district
+
+    For each district, looks up the BRMAs of its centre, of points around it (half way to
+    the nearest of its nearby districts), and of the centres of its nearby districts, and
+    ranks them with the BRMA of the centre first and then by how often they were found
+    """
+
+    from shapely.geometry import Point
+
+    districts = load_districts(infile)
+
+    def location(district):
+        try:
+            return float(district["Easting"]), float(district["Northing"])
+        except (KeyError, ValueError):
+            return None
+
+    table = {}
+    for postcode, district in districts.items():
+        centre = location(district)
+        if not centre:
+            continue
+
+        nearby = [location(districts[name.strip()]) for name in district["Nearby districts"].split(",") if name.strip() in districts]
+        nearby = [point for point in nearby if point]
+
+        radius = min([math.hypot(x - centre[0], y - centre[1]) for x, y in nearby] or [0]) / 2
+        samples = [(centre[0] + radius * math.cos(2 * math.pi * i / SAMPLE_DIRECTIONS),
+                    centre[1] + radius * math.sin(2 * math.pi * i / SAMPLE_DIRECTIONS)) for i in range(SAMPLE_DIRECTIONS)] if radius else []
+
+        found = Counter()
+        centre_boundary = index.find(Point(*centre))
+        for point in samples + nearby:
+            boundary = index.find(Point(*point))
+            if boundary:
+                found[boundary] += 1
+
+        candidates = [centre_boundary] if centre_boundary else []
+        candidates += [boundary for boundary, _ in found.most_common() if boundary != centre_boundary]
+        if candidates:
+            table[postcode] = candidates[:MAX_CANDIDATES]
+
+    return table
+
+
+def load_district_boundaries(index, key, infile=DISTRICTS_FILE):
+    """Load the district table for the boundaries cached under the given key, working it out first if needed"""
+
+    path = cache_file(key, "district-brmas.csv")
+    table = {}
+
+    if os.path.isfile(path) and os.path.getmtime(path) >= os.path.getmtime(infile):
+        with open(path, newline='') as csvfile:
+            reader = csv.reader(csvfile)
+            next(reader)
+            for row in reader:
+                table[row[0]] = row[1:]
+
+    else:
+        table = precompute_district_boundaries(index, infile)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", 'w', newline='') as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(["Postcode", "BRMAs"])
+            for postcode, candidates in table.items():
+                writer.writerow([postcode] + candidates)
+        os.replace(path + ".tmp", path)
+
+    return DistrictBoundaries(table)
@@ -0,0 +1,90 @@
+import os
+
+
+class CrawlJournal(object):
+    """Journal of the (postcode, page) units of a crawl that have been written to its output file
+
+    Each entry is appended (and synced to disk) only after the rows for that page have been
+    written and synced, and records how far into the output file those rows reach. When a
+    crawl is restarted, anything past the last recorded position (i.e. part of a page that
+    was being written when the crawl stopped) is removed, and finished work is skipped.
+    Once a crawl has completed, the next crawl starts a fresh journal rather than resuming.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.pages = {}
+        self.finished = set()
+        self.committed = None
+        self.completed = False
+
+        if os.path.isfile(path):
+            self._load()
+
+    def _load(self):
+        with open(self.path, 'r+', newline='') as journal:
+            complete = 0
+            for line in journal:
+                # Ignore a final entry that was only partly written
+                if not line.endswith("\n"):
+                    break
+                complete += len(line.encode())
+
+                entry = line.rstrip("\n").split("\t")
+                if entry[0] == "start":
+                    self.committed = int(entry[1])
+                elif entry[0] == "page":
+                    postcode, page, offset, last = entry[1], int(entry[2]), int(entry[3]), entry[4] == "1"
+                    self.pages[postcode] = max(page, self.pages.get(postcode, 0))
+                    self.committed = offset
+                    if last:
+                        self.finished.add(postcode)
+                elif entry[0] == "done":
+                    self.completed = True
+
+            journal.truncate(complete)
+
+    def _write(self, entry, mode='a'):
+        with open(self.path, mode, newline='') as journal:
+            journal.write("\t".join(str(x) for x in entry) + "\n")
+            journal.flush()
+            os.fsync(journal.fileno())
+
+    @property
+    def started(self):
+        """Whether the crawl this journal belongs to has been started before"""
+        return self.committed is not None
+
+    @property
+    def resumable(self):
+        """Whether a crawl was started before and stopped without completing"""
+        return self.started and not self.completed
+
+    def start(self, offset):
+        """Start a new journal for a crawl writing to an output file that is currently `offset` bytes long"""
+        self.pages = {}
+        self.finished = set()
+        self.committed = offset
+        self.completed = False
+        self._write(["start", offset], 'w')
+
+    def complete(self):
+        """Record that the crawl has completed, so the next one starts afresh"""
+        self.completed = True
+        self._write(["done"])
+
+    def is_finished(self, postcode):
+        """Whether every page for the given postcode has been written"""
+        return postcode in self.finished
+
+    def next_page(self, postcode):
+        """Return the first page for the given postcode that hasn't been written yet"""
+        return self.pages.get(postcode, 0) + 1
+
+    def record_page(self, postcode, page, offset, last=False):
+        """Record that a page of results has been written, with the output file now `offset` bytes long"""
+        self.pages[postcode] = page
+        self.committed = offset
+        if last:
+            self.finished.add(postcode)
+        self._write(["page", postcode, page, offset, 1 if last else 0])
@@ -1,16 +1,31 @@
 
 if __name__ == "__main__":
     import sys
+    import logging
     import traceback
     from datetime import datetime
 
+    # Set the level to DEBUG to see every listing as it is collected
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    # Write the metrics reported by each stage to a file, as JSON lines
+    # (set profile_dir as well to profile each stage with cProfile)
+    import metrics
+    metrics.configure(path="output/test/metrics.jsonl")
+
     # # Scrape information from the web about currently available properties in the UK
     # # based on a list of UK postcodes (optionally starting from a given postcode)
     # try:
     #     from properties import snapshot_properties
     #     print("Collecting properties....")
     #     start_time = datetime.now()
-    #     snapshot_properties(outfile="output/test/properties.csv", short_run=False, min_beds=2, max_beds=2)
+    #     with metrics.stage("snapshot_properties"):
+    #         snapshot_properties(outfile="output/test/properties.csv", short_run=False, min_beds=2, max_beds=2)
+    #         # Or, to crawl only the districts likely to find new listings (see planner.py):
+    #         # from planner import YIELDS_FILE, load_yields, plan_crawl
+    #         # plan = plan_crawl(yields=load_yields(YIELDS_FILE))
+    #         # snapshot_properties(outfile="output/test/properties.csv", postcodes=plan.postcodes, min_new_share=plan.min_new_share,
+    #         #                     yields_file=YIELDS_FILE, min_beds=2, max_beds=2)
     #     end_time = datetime.now()
     #     print("Finished running in: {}".format(end_time - start_time))
     # except:
@@ -24,7 +39,8 @@ if __name__ == "__main__":
     #     from cleaner import remove_duplicates
     #     print("Removing duplicates....")
     #     start_time = datetime.now()
-    #     remove_duplicates(infile="output/test/properties.csv", outfile="output/test/properties.csv")
+    #     with metrics.stage("remove_duplicates"):
+    #         remove_duplicates(infile="output/test/properties.csv", outfile="output/test/properties.csv")
     #     end_time = datetime.now()
     #     print("Finished running in: {}".format(end_time - start_time))
     # except:
@@ -38,7 +54,8 @@ if __name__ == "__main__":
     #     from boundaries import apply_boundaries
     #     print("Applying boundaries....")
     #     start_time = datetime.now()
-    #     apply_boundaries(infile="output/test/properties.csv", outfile="output/test/properties.csv", overwrite=True)
+    #     with metrics.stage("apply_boundaries"):
+    #         apply_boundaries(infile="output/test/properties.csv", outfile="output/test/properties.csv", overwrite=True)
     #     end_time = datetime.now()
     #     print("Finished running in: {}".format(end_time - start_time))
     # except:
@@ -53,8 +70,10 @@ if __name__ == "__main__":
     #     from analysis import analysis_to_file, create_overview_by_brma, total_listings, count_recent_scraped_listings, count_recent_listings
     #     print("Analysing data....")
     #     start_time = datetime.now()
-    #     analysis_to_file(infile="output/test/properties.csv", outfile="output/test/analysis.csv")
-    #     create_overview_by_brma("output/test/properties.csv", "output/test/by brma.csv")
+    #     with metrics.stage("analysis_to_file"):
+    #         analysis_to_file(infile="output/test/properties.csv", outfile="output/test/analysis.csv")
+    #     with metrics.stage("create_overview_by_brma"):
+    #         create_overview_by_brma("output/test/properties.csv", "output/test/by brma.csv")
     #     end_time = datetime.now()
     #     print("Finished running in: {}".format(end_time - start_time))
     # except:
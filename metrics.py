@@ -0,0 +1,200 @@
+import cProfile
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from datetime import datetime
+
+
+# Upper bounds of the histogram buckets (e.g. in seconds), with a final bucket for anything larger
+BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120]
+
+
+class Histogram(object):
+    """Counts of observed values in fixed buckets, along with their count, sum, minimum and maximum"""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "sum": self.total,
+            "min": self.min,
+            "max": self.max,
+            "buckets": dict(zip([str(bound) for bound in self.buckets] + ["+Inf"], self.counts))
+        }
+
+
+class Metrics(object):
+    """Counters, gauges, histograms and events reported by the stages of the pipeline
+
+    Metrics are collected in memory (which is cheap enough to leave on) and written out as
+    JSON lines to `path` at the end of each stage, if a path is given. Metrics can be
+    tagged (e.g. with a BRMA), and each line records the stage it was reported in.
+
+    Stages can also be profiled with cProfile, writing the stats for each to `profile_dir`
+    """
+
+    def __init__(self, path=None, profile_dir=None):
+        self.path = path
+        self.profile_dir = profile_dir
+        self.lock = threading.Lock()
+        self.stages = []
+        self._reset()
+
+    def _reset(self):
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    @staticmethod
+    def _key(name, tags):
+        return name, tuple(sorted(tags.items()))
+
+    def _write(self, records):
+        if not self.path:
+            return
+        with open(self.path, 'a') as metrics_file:
+            for record in records:
+                metrics_file.write(json.dumps(record) + "\n")
+
+    def _record(self, kind, name, tags=(), **fields):
+        record = {"time": datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f"), "stage": self.stages[-1] if self.stages else None, "type": kind, "name": name}
+        if tags:
+            record["tags"] = dict(tags)
+        record.update(fields)
+        return record
+
+    def increment(self, name, value=1, **tags):
+        """Add to a counter"""
+        key = self._key(name, tags)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def gauge(self, name, value, **tags):
+        """Set a gauge (a value where only the latest matters, e.g. a rate)"""
+        with self.lock:
+            self.gauges[self._key(name, tags)] = value
+
+    def observe(self, name, value, **tags):
+        """Add a value to a histogram"""
+        key = self._key(name, tags)
+        with self.lock:
+            try:
+                histogram = self.histograms[key]
+            except KeyError:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name, **tags):
+        """Time a block of code, adding the seconds it took to a histogram"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **tags)
+
+    def event(self, name, **fields):
+        """Write a one-off event straight away"""
+        with self.lock:
+            self._write([self._record("event", name, **fields)])
+
+    def flush(self):
+        """Write out every metric collected so far, and start collecting afresh"""
+        with self.lock:
+            records = [self._record("counter", name, tags, value=value) for (name, tags), value in self.counters.items()]
+            records += [self._record("gauge", name, tags, value=value) for (name, tags), value in self.gauges.items()]
+            records += [self._record("histogram", name, tags, **histogram.to_dict()) for (name, tags), histogram in self.histograms.items()]
+            self._reset()
+            self._write(records)
+
+    @contextmanager
+    def stage(self, name, profile=None):
+        """Run a stage of the pipeline, recording how long it took and writing out its metrics at the end
+
+        Set `profile` to profile the stage with cProfile (by default, stages are profiled
+        if there is a profile_dir). The stats are written to `profile_dir`/`name`.prof
+        """
+
+        if profile is None:
+            profile = bool(self.profile_dir)
+        profiler = cProfile.Profile() if profile else None
+
+        self.flush()
+        self.stages.append(name)
+        self.event("stage_started")
+        status = "failed"
+        start = time.perf_counter()
+        if profiler:
+            profiler.enable()
+        try:
+            yield self
+            status = "finished"
+        finally:
+            seconds = time.perf_counter() - start
+            fields = {"status": status, "seconds": seconds}
+            if profiler:
+                profiler.disable()
+                profile_dir = self.profile_dir or "."
+                os.makedirs(profile_dir, exist_ok=True)
+                fields["profile"] = os.path.join(profile_dir, "{}.prof".format(name))
+                profiler.dump_stats(fields["profile"])
+            self.flush()
+            self.event("stage_" + status, **fields)
+            self.stages.pop()
+
+
+# Metrics for the whole pipeline; stages report through the functions below
+METRICS = Metrics()
+
+
+def configure(path=None, profile_dir=None):
+    """Set where metrics are written (as JSON lines), and where stage profiles are written (if at all)"""
+    if path and os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    METRICS.path = path
+    METRICS.profile_dir = profile_dir
+
+
+def increment(name, value=1, **tags):
+    METRICS.increment(name, value, **tags)
+
+
+def gauge(name, value, **tags):
+    METRICS.gauge(name, value, **tags)
+
+
+def observe(name, value, **tags):
+    METRICS.observe(name, value, **tags)
+
+
+def timer(name, **tags):
+    return METRICS.timer(name, **tags)
+
+
+def event(name, **fields):
+    METRICS.event(name, **fields)
+
+
+def flush():
+    METRICS.flush()
+
+
+def stage(name, profile=None):
+    return METRICS.stage(name, profile)
@@ -0,0 +1,187 @@
+import csv
+import queue
+import threading
+import metrics
+from constants import FIELDS
+from sinks import QueueListingSink
+from properties import API_URL, NestoriaClient, crawl_postcodes, load_postcodes
+from response_cache import ResponseCache
+from planner import YieldTracker
+from cleaner import url_hash
+from boundaries import CHUNK_SIZE, BoundaryAssigner
+from analysis import aggregate_rows, write_analysis
+
+
+# Number of batches of rows held between two stages (a stage waits for the next one to
+# catch up when its queue is full), and the number of rows in each batch
+QUEUE_SIZE = 16
+BATCH_SIZE = 1000
+
+_DONE = object()
+
+
+class _Failed(object):
+    def __init__(self, exception):
+        self.exception = exception
+
+
+def threaded(rows, queue_size=QUEUE_SIZE, batch_size=BATCH_SIZE):
+    """Run a stage (a generator of rows) in its own thread, passing its rows on through a bounded queue"""
+
+    batches = queue.Queue(queue_size)
+
+    def run():
+        try:
+            batch = []
+            for row in rows:
+                batch.append(row)
+                if len(batch) >= batch_size:
+                    batches.put(batch)
+                    batch = []
+            if batch:
+                batches.put(batch)
+            batches.put(_DONE)
+        except BaseException as e:
+            batches.put(_Failed(e))
+
+    threading.Thread(target=run, daemon=True).start()
+    return _drain(batches)
+
+
+def _drain(batches):
+    """Yield the rows from batches put on a queue, until the stage putting them finishes (or fails)"""
+    while True:
+        batch = batches.get()
+        if batch is _DONE:
+            return
+        if isinstance(batch, _Failed):
+            raise batch.exception
+        for row in batch:
+            yield row
+
+
+def as_csv_row(row):
+    """Return a row with its values as they would be read back from a CSV file"""
+    return {name: "" if row.get(name) is None else str(row[name]) for name in FIELDS}
+
+
+def scraped_rows(start_from=None, short_run=False, min_beds=None, max_beds=None, workers=1, cache_dir=None,
+                 replay=False, api_url=API_URL, postcodes=None, min_new_share=None, queue_size=QUEUE_SIZE):
+    """Crawl Nestoria (see snapshot_properties), yielding each listing found as a row
+
+    Unlike snapshot_properties, the crawl isn't journalled, so it can't be resumed
+    """
+
+    pages = queue.Queue(queue_size)
+    sink = QueueListingSink(pages)
+    cache = ResponseCache(cache_dir) if cache_dir else None
+    client = NestoriaClient(api_url, cache=cache, replay=replay)
+    tracker = YieldTracker() if min_new_share is not None else None
+    if postcodes is None:
+        postcodes = load_postcodes(start_from)
+
+    def crawl():
+        try:
+            with sink:
+                crawl_postcodes(sink, postcodes, short_run, min_beds, max_beds, workers, client, threading.Lock(), None, tracker, min_new_share)
+            pages.put(_DONE)
+        except BaseException as e:
+            pages.put(_Failed(e))
+
+    threading.Thread(target=crawl, daemon=True).start()
+
+    for row in _drain(pages):
+        yield as_csv_row(dict(zip(FIELDS, row)))
+
+
+def file_rows(infile):
+    """Yield the rows of a properties file"""
+    with open(infile, 'r', newline='') as csvfile:
+        reader = csv.DictReader(csvfile, fieldnames=FIELDS)
+        next(reader)
+        for row in reader:
+            yield row
+
+
+def deduplicated(rows):
+    """Yield only the first listing for each property (as remove_duplicates does)"""
+
+    seen = set()
+    dropped = 0
+    for row in rows:
+        key = url_hash(row)
+        if key not in seen:
+            seen.add(key)
+            yield row
+        else:
+            dropped += 1
+
+    print("[*] Removed {} duplicates".format(dropped))
+    metrics.increment("cleaner.duplicates_dropped", dropped)
+
+
+def with_boundaries(rows, overwrite=True, chunk_size=CHUNK_SIZE):
+    """Yield the rows with their BRMA and affordability filled in (as apply_boundaries does)"""
+
+    assigner = BoundaryAssigner(overwrite)
+    chunk = []
+
+    def assign(chunk):
+        metrics.increment("boundaries.rows", len(chunk))
+        return [as_csv_row(row) for row in assigner.assign(chunk)]
+
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            for assigned in assign(chunk):
+                yield assigned
+            chunk = []
+
+    for assigned in assign(chunk):
+        yield assigned
+
+    if assigner.district_boundaries.hit_rate is not None:
+        print("[*] Postcode district table hit rate: {:.1%}".format(assigner.district_boundaries.hit_rate))
+    metrics.increment("boundaries.snapped", assigner.snapped)
+    if assigner.snapped:
+        print("[*] Snapped {} properties to the nearest BRMA (within {}m)".format(assigner.snapped, assigner.snap_tolerance))
+
+
+def tapped(rows, outfile):
+    """Write the rows passing through to a CSV file"""
+    with open(outfile, 'w', newline='') as outcsv:
+        writer = csv.DictWriter(outcsv, fieldnames=FIELDS)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(row)
+            yield row
+
+
+def run_pipeline(analysis_file, infile=None, tap=None, all_categories=False, queue_size=QUEUE_SIZE, **crawl_options):
+    """Collect properties, remove duplicates, apply boundaries and write the analysis, in a single pass
+
+    Each stage runs in its own thread, passing rows on to the next through a bounded
+    queue, so properties are analysed as they are collected without being written to
+    (and read back from) a file between each stage. The analysis is the same as running
+    the stages one after another.
+
+    Properties are collected from Nestoria (with `crawl_options` as for snapshot_properties),
+    or read from `infile` if given (e.g. a crawl that has already been made). If `tap` is
+    given, the properties (with their boundaries) are also written to that file
+
+    Returns the groups of the analysis (see aggregate_by_brma)
+    """
+
+    if infile:
+        rows = file_rows(infile)
+    else:
+        rows = scraped_rows(queue_size=queue_size, **crawl_options)
+
+    rows = threaded(deduplicated(threaded(rows, queue_size)), queue_size)
+    rows = threaded(with_boundaries(rows), queue_size)
+    if tap:
+        rows = tapped(rows, tap)
+
+    groups = aggregate_rows(rows)
+    write_analysis(groups, analysis_file, all_categories)
+    return groups
@@ -0,0 +1,201 @@
+import csv
+import math
+import threading
+from cleaner import url_hash
+from constants import FIELDS
+from watermark import load_state, save_state
+
+
+DISTRICTS_FILE = "postcode-districts.csv"
+
+# Listings found for each district on previous crawls (see YieldTracker)
+YIELDS_FILE = "crawl-yields.json"
+
+# Listings returned per page by the API (see NestoriaClient.url)
+RESULTS_PER_PAGE = 50
+
+# Most pages expected for a district that hasn't been crawled before
+MAX_PAGES = 20
+
+# For districts that haven't been crawled before: how many listings to expect per household,
+# the number of households to assume for each active postcode where the count is missing, and
+# the share of a district's listings expected to have been found already for each of its nearby
+# districts crawled before it (searches for neighbouring districts return overlapping listings)
+LISTINGS_PER_HOUSEHOLD = 0.005
+HOUSEHOLDS_PER_POSTCODE = 14
+NEARBY_OVERLAP = 0.15
+
+# Districts expected to find fewer new listings than this for each request are left out of the plan
+MIN_EXPECTED_NEW = 1.0
+
+# A district stops being paginated once the share of new listings on a page falls below this
+# (the min_new_share a CrawlPlan is crawled with, unless another is given to plan_crawl)
+MIN_NEW_SHARE = 0.2
+
+
+def load_yields(path=YIELDS_FILE):
+    """Load the listings found for each district on previous crawls, keyed by postcode"""
+    return load_state(path)
+
+
+class YieldTracker(object):
+    """Counts the pages, listings and new listings (not found earlier in the crawl) for each district
+
+    Used while crawling to decide whether a district is still worth paginating, and saved
+    afterwards (added to the counts from previous crawls) for planning the next crawl
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.seen = set()
+        self.districts = {}
+
+    def record_page(self, postcode, rows):
+        """Record a page of rows (lists of values, in the order of FIELDS) found for a district
+
+        Returns the share of the rows that are new listings, or None if the page was empty
+        """
+
+        keys = [url_hash(dict(zip(FIELDS, row))) for row in rows]
+        with self.lock:
+            new = 0
+            for key in keys:
+                if key not in self.seen:
+                    self.seen.add(key)
+                    new += 1
+
+            counts = self.districts.setdefault(postcode, {"pages": 0, "listings": 0, "new": 0})
+            counts["pages"] += 1
+            counts["listings"] += len(rows)
+            counts["new"] += new
+
+        return new / len(rows) if rows else None
+
+    def save(self, path=YIELDS_FILE):
+        """Add the counts for this crawl to those from previous crawls"""
+
+        yields = load_yields(path)
+        with self.lock:
+            for postcode, counts in self.districts.items():
+                total = yields.setdefault(postcode, {"runs": 0, "pages": 0, "listings": 0, "new": 0})
+                total["runs"] += 1
+                for name, value in counts.items():
+                    total[name] += value
+        save_state(path, yields)
+
+
+class CrawlPlan(object):
+    """The districts to crawl (most productive first), with the number of requests each is expected to take
+
+    Each planned district is a dictionary of its postcode, expected pages, listings and new
+    listings. Districts left out of the plan are kept, with the reason, in `skipped`. The
+    plan should be crawled with its `min_new_share` (see snapshot_properties)
+    """
+
+    def __init__(self, districts, skipped, min_new_share=MIN_NEW_SHARE):
+        self.districts = districts
+        self.skipped = skipped
+        self.min_new_share = min_new_share
+
+    @property
+    def postcodes(self):
+        return [district["postcode"] for district in self.districts]
+
+    @property
+    def estimated_calls(self):
+        return sum(district["pages"] for district in self.districts)
+
+    def to_file(self, outfile):
+        """Write the plan to a CSV file, including the districts left out of it"""
+        with open(outfile, 'w', newline='') as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(["Postcode", "Pages", "Expected Listings", "Expected New Listings", "Skipped"])
+            for district in self.districts:
+                writer.writerow([district["postcode"], district["pages"], round(district["listings"], 1), round(district["new"], 1), ""])
+            for postcode, reason in self.skipped.items():
+                writer.writerow([postcode, 0, "", "", reason])
+
+
+def _expected_yield(district, history, max_pages):
+    """Return the listings and pages expected for a district, and the share of them expected to be new (if known)"""
+
+    if history and history["runs"] and history["pages"]:
+        listings = history["listings"] / history["runs"]
+        pages = max(1, int(math.ceil(history["pages"] / history["runs"])))
+        new_share = history["new"] / history["listings"] if history["listings"] else 0
+        return listings, pages, new_share
+
+    try:
+        households = int(district["Households"])
+    except ValueError:
+        households = int(district["Active postcodes"]) * HOUSEHOLDS_PER_POSTCODE
+    listings = households * LISTINGS_PER_HOUSEHOLD
+    pages = min(max(1, int(math.ceil(listings / RESULTS_PER_PAGE))), max_pages)
+    return listings, pages, None
+
+
+def plan_crawl(districts_file=DISTRICTS_FILE, yields=None, min_expected_new=MIN_EXPECTED_NEW, max_calls=None, max_pages=MAX_PAGES,
+               min_new_share=MIN_NEW_SHARE):
+    """Plan which districts to crawl, and in what order, to find the most new listings for the fewest requests
+
+    Districts without any active postcodes are left out. The others are ranked by the
+    listings expected for each request: from previous crawls (see YieldTracker) where
+    there are any, or otherwise from the number of households. Going down the ranking,
+    the listings expected to be new are the share that were new on previous crawls, or
+    otherwise are reduced for each nearby district already in the plan. Districts expected
+    to find fewer than `min_expected_new` new listings per request are left out, as are
+    any that would take the plan over `max_calls` requests. The plan is to be crawled with
+    `min_new_share`, as the yields from previous crawls were
+    """
+
+    yields = yields or {}
+    with open(districts_file) as csvfile:
+        districts = list(csv.DictReader(csvfile))
+
+    skipped = {}
+    ranked = []
+    for district in districts:
+        postcode = district["Postcode"]
+        if not int(district["Active postcodes"] or 0):
+            skipped[postcode] = "no active postcodes"
+            continue
+        listings, pages, new_share = _expected_yield(district, yields.get(postcode), max_pages)
+        ranked.append((listings / pages, district, listings, pages, new_share))
+
+    ranked.sort(key=lambda candidate: -candidate[0])
+
+    planned = []
+    planned_postcodes = set()
+    calls = 0
+    for _, district, listings, pages, new_share in ranked:
+        postcode = district["Postcode"]
+        if new_share is None:
+            nearby = [name.strip() for name in district["Nearby districts"].split(",")]
+            new_share = (1 - NEARBY_OVERLAP) ** sum(1 for name in nearby if name in planned_postcodes)
+        new = listings * new_share
+
+        if new / pages < min_expected_new:
+            skipped[postcode] = "{:.1f} new listings expected per request".format(new / pages)
+        elif max_calls is not None and calls + pages > max_calls:
+            skipped[postcode] = "over budget"
+        else:
+            planned.append({"postcode": postcode, "pages": pages, "listings": listings, "new": new})
+            planned_postcodes.add(postcode)
+            calls += pages
+
+    return CrawlPlan(planned, skipped, min_new_share)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Plan a crawl of the postcode districts, estimating the number of requests it will take")
+    parser.add_argument("outfile", help="CSV file to write the plan to")
+    parser.add_argument("--yields", default=YIELDS_FILE, help="listings found on previous crawls (see YieldTracker)")
+    parser.add_argument("--min-expected-new", type=float, default=MIN_EXPECTED_NEW)
+    parser.add_argument("--max-calls", type=int)
+    args = parser.parse_args()
+
+    plan = plan_crawl(yields=load_yields(args.yields), min_expected_new=args.min_expected_new, max_calls=args.max_calls)
+    plan.to_file(args.outfile)
+    print("[*] Planned {} districts ({} left out), estimated {} requests".format(len(plan.districts), len(plan.skipped), plan.estimated_calls))
@@ -1,89 +1,295 @@
 import csv
 import time
+import logging
+import threading
 import requests
-import os.path
+import metrics
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
 from json import loads
-from constants import FIELDS
+from journal import CrawlJournal
+from sinks import ListingSink, CSVListingSink
+from response_cache import ResponseCache
+from planner import YieldTracker
 from datetime import datetime, timedelta
 
 
-DELAY = 1.25
-
-def snapshot_properties(outfile, start_from=None, short_run=False, min_beds=None, max_beds=None):
-    """Create a snapshot of 'all' (or as many as can be found) properties available for rent in the UK"""
+API_URL = "https://api.nestoria.co.uk/api"
 
-    # Initialise list of postcodes
-    postcodes = []
-    with open("postcode-districts.csv") as csvfile:
-        reader = csv.DictReader(csvfile)
-        for row in reader:
-            postcodes.append(row["Postcode"])
+# Minimum time between requests to the API (across all workers)
+DELAY = 1.25
 
-    # To continue from a previous run, set start_from to the postcode you want
-    # (just make sure to remove existing instances to avoid duplicates)
-    postcodes = postcodes[postcodes.index(start_from):] if start_from else postcodes
-    if start_from:
-        print("#####################################")
-        print("Starting from {}".format(start_from))
-        print("#####################################")
+# Retry failed requests with exponential backoff, up to a limit
+MAX_RETRIES = 8
+INITIAL_BACKOFF = 2
+MAX_BACKOFF = 120
+REQUEST_TIMEOUT = 30
 
-    if not os.path.isfile(outfile):
-        with open(outfile, 'w', newline='') as csvfile:
-            writer = csv.writer(csvfile)
-            writer.writerow(FIELDS)
+# Number of keep-alive connections each session holds open to the API
+POOL_SIZE = 4
 
-    for postcode in postcodes:
-        get_nestoria_properties(outfile, postcode, short_run, min_beds, max_beds)
+# Progress is logged through the standard logging module: the title of every listing
+# found is logged at DEBUG level, so it can be switched on and off with the log level
+log = logging.getLogger(__name__)
 
 
-def get_nestoria_properties(outfile, postcode, short_run, min_beds, max_beds):
+class NestoriaUnavailableException(Exception):
+    """This exception is raised if a page of results can't be fetched from Nestoria after retrying"""
+    pass
 
-    start = None
-    page = 1
 
-    # Pagination
-    while True:
+class TokenBucket(object):
+    """Thread-safe token bucket, limiting how often requests can be made
 
-        end = time.time()
-        function_time = end - start if start else 0
-        if(DELAY - function_time > 0):
-            time.sleep(DELAY - function_time)
+    Tokens are added at `rate` per second, up to `capacity` (the largest burst allowed),
+    and each request has to take one before it is made
+    """
 
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
 
+    def acquire(self):
+        """Block until a token is available, then take it"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class NestoriaClient(object):
+    """Fetches pages of results from the Nestoria API
+
+    Requests are made through pooled, keep-alive sessions (one per thread), and are rate
+    limited by a TokenBucket shared by every thread. Failed requests are retried with capped
+    exponential backoff.
+
+    If a ResponseCache is given, every response is saved to it. In replay mode responses are
+    only ever read from the cache, and no requests are made at all.
+    """
+
+    def __init__(self, api_url=API_URL, limiter=None, cache=None, replay=False):
+        if replay and not cache:
+            raise ValueError("Replaying responses requires a ResponseCache")
+
+        self.api_url = api_url
+        self.limiter = limiter or TokenBucket(1 / DELAY)
+        self.cache = cache
+        self.replay = replay
+        self.local = threading.local()
+
+    def session(self):
+        """Return the session for the current thread"""
+        try:
+            return self.local.session
+        except AttributeError:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            self.local.session = session
+            return session
+
+    def url(self, postcode, page, min_beds=None, max_beds=None):
         url_min_beds = "&bedroom_min={}".format(min_beds) if min_beds else ""
         url_max_beds = "&bedroom_max={}".format(max_beds) if max_beds else ""
 
-        url = "https://api.nestoria.co.uk/api?action=search_listings&encoding=json&country=uk&number_of_results=50&listing_type=rent&place_name={}&page={}{}{}".format(
+        return "{}?action=search_listings&encoding=json&country=uk&number_of_results=50&listing_type=rent&place_name={}&page={}{}{}".format(
+            self.api_url,
             postcode,
             page,
             url_min_beds,
             url_max_beds
         )
 
-        timeout = 2
-        while True:
+    def cache_key(self, url):
+        # Cache responses by the search itself, so a crawl made against one server
+        # (e.g. a local stand-in) can be replayed without it
+        return urlsplit(url).query
+
+    def fetch(self, url):
+        """Return the decoded response for a URL, and the time it was fetched
+
+        In replay mode, returns an empty response (fetched now) if the URL isn't in the cache
+        """
+
+        if self.replay:
+            cached = self.cache.get(self.cache_key(url))
+            if not cached:
+                log.warning("No cached response for {}".format(url))
+                metrics.increment("nestoria.replay_misses")
+                return {}, datetime.now()
+            metrics.increment("nestoria.replayed_responses")
+            text, fetched = cached
+            return loads(text)["response"], fetched
+
+        backoff = INITIAL_BACKOFF
+        for attempt in range(MAX_RETRIES + 1):
+            with metrics.timer("nestoria.rate_limit_wait_seconds"):
+                self.limiter.acquire()
             try:
-                response = requests.get(url)
+                with metrics.timer("nestoria.request_seconds"):
+                    response = self.session().get(url, timeout=REQUEST_TIMEOUT)
+                metrics.increment("nestoria.requests", status=response.status_code)
+                response.raise_for_status()
+                fetched = datetime.now()
+                json = loads(response.text)["response"]
                 break
+            except (requests.RequestException, ValueError, KeyError) as e:
+                metrics.increment("nestoria.request_errors", error=type(e).__name__)
+                if attempt == MAX_RETRIES:
+                    raise NestoriaUnavailableException(url) from e
+                metrics.increment("nestoria.retries")
+                log.warning("Couldn't connect to Nestoria ({}), waiting {} seconds and trying again...".format(e, backoff))
+                time.sleep(backoff)
+                backoff = min(backoff * 2, MAX_BACKOFF)
+
+        if self.cache:
+            self.cache.put(self.cache_key(url), response.text, fetched)
+
+        return json, fetched
+
+
+def snapshot_properties(outfile, start_from=None, short_run=False, min_beds=None, max_beds=None, workers=1, sink=None,
+                        cache_dir=None, replay=False, api_url=API_URL, postcodes=None, min_new_share=None, yields_file=None):
+    """Create a snapshot of 'all' (or as many as can be found) properties available for rent in the UK
+
+    Optionally, set `workers` to crawl several postcodes at once. Requests from every worker
+    share the same rate limit, so this hides the time spent waiting on the network rather than
+    making requests any more often
+
+    Progress is recorded in a journal next to the output file (`outfile` + ".journal"), so if
+    a run stops part way through, running it again with the same outfile picks up where it
+    left off. Once a run has completed, the next run with the same outfile crawls every
+    postcode again, adding to the file
+
+    Listings are written to a CSVListingSink for outfile, unless another ListingSink is given
+
+    If `cache_dir` is given, every raw response is saved there. With `replay` set as well, the
+    snapshot is rebuilt from the saved responses instead, without making any requests (e.g. to
+    re-run the parsing after changing it). `api_url` can point the crawl at a different server
+
+    By default every postcode district is crawled; `postcodes` can be given instead (e.g.
+    the postcodes of a CrawlPlan, see planner.py). With `min_new_share` set, a district
+    stops being paginated once less than that share of the listings on a page are new to
+    the crawl. With `yields_file` set, the listings found for each district are added to
+    that file, for planning later crawls
+    """
+
+    # Runs that stopped part way through are resumed automatically (see below), but
+    # start_from can still be used to skip ahead to a given postcode
+    if postcodes is None:
+        postcodes = load_postcodes(start_from)
+    elif start_from:
+        postcodes = postcodes[postcodes.index(start_from):]
+
+    sink = sink or CSVListingSink(outfile)
+
+    journal = CrawlJournal(outfile + ".journal")
+    resume = journal.resumable
+    if resume:
+        # Remove any rows from a page that was only partly written before the last run stopped
+        try:
+            sink.truncate(journal.committed)
+        except ValueError as e:
+            log.warning("Not resuming previous run, its journal doesn't match the output ({})".format(e))
+            resume = False
+
+    if resume:
+        postcodes = [postcode for postcode in postcodes if not journal.is_finished(postcode)]
+        log.info("Resuming previous run, {} postcodes left to collect".format(len(postcodes)))
+    else:
+        journal.start(sink.flush())
+
+    cache = ResponseCache(cache_dir) if cache_dir else None
+    client = NestoriaClient(api_url, cache=cache, replay=replay)
+    lock = threading.Lock()
+    tracker = YieldTracker() if min_new_share is not None or yields_file else None
+
+    with sink:
+        crawl_postcodes(sink, postcodes, short_run, min_beds, max_beds, workers, client, lock, journal, tracker, min_new_share)
+    journal.complete()
+
+    if yields_file:
+        tracker.save(yields_file)
+
+
+def load_postcodes(start_from=None):
+    """Return the postcode districts to crawl, optionally starting from a given postcode"""
+
+    postcodes = []
+    with open("postcode-districts.csv") as csvfile:
+        reader = csv.DictReader(csvfile)
+        for row in reader:
+            postcodes.append(row["Postcode"])
+
+    if start_from:
+        log.info("Starting from {}".format(start_from))
+        return postcodes[postcodes.index(start_from):]
+    return postcodes
+
+
+def crawl_postcodes(sink, postcodes, short_run, min_beds, max_beds, workers, client, lock, journal=None, tracker=None, min_new_share=None):
+
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(get_nestoria_properties, sink, postcode, short_run, min_beds, max_beds, client, lock, journal, tracker, min_new_share) for postcode in postcodes]
+            try:
+                for future in futures:
+                    future.result()
             except:
-                print("Couldn't connect to Nestoria, waiting {} seconds and trying again...".format(timeout))
-                time.sleep(timeout)
-                timeout *= 2
+                # Don't carry on crawling the remaining postcodes if one of them failed
+                for future in futures:
+                    future.cancel()
+                raise
+
+    else:
+        for postcode in postcodes:
+            get_nestoria_properties(sink, postcode, short_run, min_beds, max_beds, client, lock, journal, tracker, min_new_share)
+
 
-        start = time.time()
+def get_nestoria_properties(sink, postcode, short_run, min_beds, max_beds, client=None, lock=None, journal=None,
+                            tracker=None, min_new_share=None):
+    """Collect every page of listings for a postcode, writing them to the given ListingSink (or CSV file)
 
-        json = loads(response.text)["response"]
+    If a YieldTracker is given, each page is recorded with it, and pagination stops early
+    once less than `min_new_share` of the listings on a page are new (if set)
+    """
+
+    if not isinstance(sink, ListingSink):
+        with CSVListingSink(sink) as csv_sink:
+            return get_nestoria_properties(csv_sink, postcode, short_run, min_beds, max_beds, client, lock, journal, tracker, min_new_share)
+
+    client = client or NestoriaClient()
+    lock = lock or threading.Lock()
+    page = journal.next_page(postcode) if journal else 1
+
+    # Pagination
+    while True:
+
+        url = client.url(postcode, page, min_beds, max_beds)
+        json, fetched = client.fetch(url)
+        rows = []
 
         try:
             x = json["listings"]
         except KeyError:
-            print("No listings returned for postcode: {}".format(postcode))
-            print(url)
-            print(json)
+            log.warning("No listings returned for postcode: {}".format(postcode))
+            log.debug(url)
+            log.debug(json)
 
-        for listing in json["listings"]:
+        for listing in json.get("listings", []):
 
-            print(listing["title"])
+            log.debug(listing.get("title"))
 
             try:
                 x = listing["latitude"]
@@ -93,7 +299,7 @@ def get_nestoria_properties(outfile, postcode, short_run, min_beds, max_beds):
                 bedrooms = int(listing["bedroom_number"])
             # Skip if one of the required properties for assessment is missing
             except KeyError:
-                print(listing)
+                log.debug(listing)
                 continue
             # Skip if, e.g. "bedroom_number" is an empty-string
             except ValueError:
@@ -133,40 +339,54 @@ def get_nestoria_properties(outfile, postcode, short_run, min_beds, max_beds):
             except KeyError:
                 title = ""
 
-            with open(outfile, 'a', newline='') as csvfile:
-                writer = csv.writer(csvfile)
-                writer.writerow([
-                    datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                    (datetime.now() - timedelta(days=int(listing["updated_in_days"]))).strftime("%Y-%m-%d"),
-                    listing["latitude"],
-                    listing["longitude"],
-                    title,
-                    postcode,
-                    "", #Add boundaries later
-                    bedrooms,
-                    "CAT {}".format(cat) if cat else "N/A",
-                    listing["price"] if listing["price_type"] == "weekly" else "",
-                    listing["price"] if listing["price_type"] == "monthly" else "",
-                    "",
-                    "Nestoria",
-                    listing["datasource_name"] if listing["datasource_name"] else "Unknown",
-                    listing["lister_url"] if listing["lister_url"] else "Unknown",
-                    listing["img_url"] if listing["img_url"] else "",
-                    "",
-                    "",
-                    listing["summary"],
-                    ""
-                ])
+            rows.append([
+                fetched.strftime("%Y-%m-%d %H:%M:%S"),
+                (fetched - timedelta(days=int(listing["updated_in_days"]))).strftime("%Y-%m-%d"),
+                listing["latitude"],
+                listing["longitude"],
+                title,
+                postcode,
+                "", #Add boundaries later
+                bedrooms,
+                "CAT {}".format(cat) if cat else "N/A",
+                listing["price"] if listing["price_type"] == "weekly" else "",
+                listing["price"] if listing["price_type"] == "monthly" else "",
+                "",
+                "Nestoria",
+                listing["datasource_name"] if listing["datasource_name"] else "Unknown",
+                listing["lister_url"] if listing["lister_url"] else "Unknown",
+                listing["img_url"] if listing["img_url"] else "",
+                "",
+                "",
+                listing["summary"],
+                "",
+                ""
+            ])
 
         # If in short run mode, only get the first page of results per postcode
-        if short_run:
-            break
-
         try:
-            if not json["page"] < json["total_pages"]:
-                break
-            else:
-                page = json["page"]+1
-
+            last = short_run or not json["page"] < json["total_pages"]
         except KeyError:
+            last = True
+
+        # Stop once the pages for this postcode are mostly listings already found elsewhere
+        if tracker:
+            new_share = tracker.record_page(postcode, rows)
+            if not last and min_new_share is not None and new_share is not None and new_share < min_new_share:
+                log.info("Stopping {} at page {}, only {:.0%} of its listings were new".format(postcode, page, new_share))
+                metrics.increment("nestoria.early_stops")
+                last = True
+
+        # Write the whole page at once, and only then record it as done
+        metrics.increment("nestoria.pages")
+        metrics.increment("nestoria.listings", len(rows))
+        metrics.increment("nestoria.skipped_listings", len(json.get("listings", [])) - len(rows))
+        with lock:
+            offset = sink.write_page(rows)
+            if journal:
+                journal.record_page(postcode, page, offset, last)
+
+        if last:
             break
+        else:
+            page = json["page"]+1
@@ -0,0 +1,234 @@
+import json
+import numpy as np
+from datetime import datetime, timedelta
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+from constants import load_LHA
+from columnar import Snapshot, is_snapshot
+from analysis import CATEGORIES
+from records import ListingTable
+from quantiles import exact_quantiles
+
+
+# Columns with a posting list (the rows holding each distinct, lower case, value)
+INDEXED_COLUMNS = ["Postcode (District)", "BRMA", "Category", "Affordable"]
+
+_NO_ROWS = np.zeros(0, dtype=np.int64)
+
+
+def _posting_lists(names, codes):
+    """Return the (sorted) rows holding each value, given the distinct values and each row's code"""
+    order = np.argsort(codes, kind='stable')
+    ends = np.cumsum(np.bincount(codes, minlength=len(names)))
+    starts = ends - np.bincount(codes, minlength=len(names))
+    return {name: order[start:end] for name, start, end in zip(names, starts, ends)}
+
+
+class SnapshotQuery(object):
+    """Answers the questions asked of a properties file (e.g. total_listings) from an index built once
+
+    The properties (a CSV file or columnar snapshot) are read once, keeping a posting list
+    of the rows for every postcode, BRMA, category and affordability, along with the dates
+    (already parsed) and weekly rents of every listing. Methods match the functions in
+    analysis.py of the same names, and answers are cached
+    """
+
+    def __init__(self, infile):
+        self.infile = infile
+        self.postings = {}
+        self.cache = {}
+
+        if is_snapshot(infile):
+            self._load_snapshot(Snapshot(infile))
+        else:
+            self._load_csv(infile)
+
+        self.rows = len(self.listed)
+
+    def _load_snapshot(self, snapshot):
+        for name in INDEXED_COLUMNS:
+            names, codes = snapshot.lower_codes(name)
+            self.postings[name] = _posting_lists(names, codes)
+
+        self.brma_names = snapshot.categories("BRMA")
+        self.brma_codes = np.asarray(snapshot.column("BRMA"))
+        self.category_names = snapshot.categories("Category")
+        self.category_codes = np.asarray(snapshot.column("Category"))
+
+        monthly = np.asarray(snapshot.column("Monthly Rent"))
+        weekly = np.asarray(snapshot.column("Weekly Rent"))
+        self.rents = np.where(np.isnan(monthly), weekly, (monthly*12)/52.1429)
+
+        self.listed = np.array(snapshot.values("Listed Date"), dtype='datetime64[us]')
+        self.scraped = np.array([value.replace(" ", "T") for value in snapshot.values("Scraped Date")], dtype='datetime64[us]')
+
+    def _load_csv(self, infile):
+        table = ListingTable()
+        with open(infile) as csvfile:
+            listings = list(table.read_csv(csvfile))
+
+        def column(attribute, dtype=np.int64):
+            return np.fromiter((getattr(listing, attribute) for listing in listings), dtype=dtype, count=len(listings))
+
+        brma_codes = column("brma")
+        category_codes = column("category")
+        for name, interner, codes in (("Postcode (District)", table.postcodes, column("postcode")),
+                                      ("BRMA", table.brmas, brma_codes),
+                                      ("Category", table.categories, category_codes)):
+            lowered = np.array(interner.lowered, dtype=np.int64)
+            self.postings[name] = _posting_lists(interner.lower_values, lowered[codes] if len(lowered) else codes)
+        self.postings["Affordable"] = _posting_lists(["false", "true"], column("affordable"))
+
+        self.brma_names = table.brmas.values
+        self.brma_codes = brma_codes
+        self.category_names = table.categories.values
+        self.category_codes = category_codes
+        self.rents = column("rent", np.float64)
+        self.listed = np.array([listing.listed for listing in listings], dtype='datetime64[us]')
+        self.scraped = np.array([listing.scraped for listing in listings], dtype='datetime64[us]')
+
+    def _posting(self, name, value):
+        return self.postings[name].get(value.lower(), _NO_ROWS)
+
+    def matching_rows(self, postcode=None, brma=None, cat=None):
+        """Return the rows matching every condition given (None meaning all rows)"""
+
+        rows = None
+        for name, value in (("Postcode (District)", postcode), ("BRMA", brma), ("Category", cat)):
+            if value:
+                posting = self._posting(name, value)
+                rows = posting if rows is None else np.intersect1d(rows, posting, assume_unique=True)
+        return rows
+
+    def _cached(self, key, answer):
+        try:
+            return self.cache[key]
+        except KeyError:
+            result = self.cache[key] = answer()
+            return result
+
+    def total_listings(self, postcode=None, brma=None, cat=None):
+        """Count the total number of listings found"""
+
+        def answer():
+            rows = self.matching_rows(postcode, brma, cat)
+            return self.rows if rows is None else len(rows)
+
+        return self._cached(("total_listings", postcode, brma, cat), answer)
+
+    def affordable_listings(self, postcode=None, brma=None, cat=None, weekly_top_up=0):
+        """Calculate how many of the listings are affordable for their particular BRMA (see analysis.affordable_listings)"""
+
+        if cat and cat not in CATEGORIES:
+            raise ValueError("Category must be in form e.g. 'CAT A'")
+
+        def answer():
+            rows = self.matching_rows(postcode, brma, cat)
+
+            if not weekly_top_up:
+                affordable = self._posting("Affordable", "true")
+                return len(affordable) if rows is None else len(np.intersect1d(rows, affordable, assume_unique=True))
+
+            rows = np.arange(self.rows) if rows is None else rows
+            return int(np.count_nonzero(self._weekly_LHA()[rows] + weekly_top_up >= self.rents[rows]))
+
+        return self._cached(("affordable_listings", postcode, brma, cat, weekly_top_up), answer)
+
+    def _weekly_LHA(self):
+        """Return the LHA rate for each listing (NaN where there isn't one)"""
+
+        def answer():
+            weekly_LHA = load_LHA()
+            table = np.full((len(self.brma_names), len(self.category_names)), np.nan)
+            for i, brma in enumerate(self.brma_names):
+                for j, cat in enumerate(self.category_names):
+                    try:
+                        table[i, j] = float(weekly_LHA[brma][cat])
+                    except KeyError:
+                        pass
+            return table[self.brma_codes, self.category_codes] if table.size else np.full(self.rows, np.nan)
+
+        return self._cached(("weekly_LHA",), answer)
+
+    def count_recent_listings(self, diff=timedelta(days=7), now=None):
+        """Return the number of properties that were listed less than a specified time (default 1 week) ago"""
+        since = np.datetime64((now or datetime.now()) - diff, 'us')
+        return int(np.count_nonzero(self.listed >= since))
+
+    def count_recent_scraped_listings(self, diff=timedelta(days=7)):
+        """Return the number of listings that were scraped within a specified time (default 1 week) of being listed"""
+
+        def answer():
+            return int(np.count_nonzero(self.listed >= self.scraped - np.timedelta64(diff)))
+
+        return self._cached(("count_recent_scraped_listings", diff), answer)
+
+    def required_LHA_percentile(self, brma, cat, percentage=0.30):
+        """Return the rent at the given percentile of the listings for a BRMA and category (see analysis.required_LHA_percentile)"""
+
+        def answer():
+            rents = self.rents[self.matching_rows(brma=brma, cat=cat)]
+            return exact_quantiles(rents[~np.isnan(rents)], [percentage])[0]
+
+        return self._cached(("required_LHA_percentile", brma, cat, percentage), answer)
+
+
+def serve(query, host="127.0.0.1", port=8000):
+    """Answer queries over HTTP, e.g. GET /total_listings?brma=Inner+North+London&cat=CAT+C
+
+    Parameters are those of the SnapshotQuery method of the same name (with `days` in
+    place of `diff`), and answers are returned as JSON: {"result": ...}
+    """
+
+    methods = {
+        "total_listings": lambda q: query.total_listings(q.get("postcode"), q.get("brma"), q.get("cat")),
+        "affordable_listings": lambda q: query.affordable_listings(q.get("postcode"), q.get("brma"), q.get("cat"), float(q.get("weekly_top_up", 0))),
+        "count_recent_listings": lambda q: query.count_recent_listings(timedelta(days=float(q.get("days", 7)))),
+        "count_recent_scraped_listings": lambda q: query.count_recent_scraped_listings(timedelta(days=float(q.get("days", 7)))),
+        "required_LHA_percentile": lambda q: query.required_LHA_percentile(q["brma"], q["cat"], float(q.get("percentage", 0.30)))
+    }
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            url = urlsplit(self.path)
+            params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+            try:
+                method = methods[url.path.strip("/")]
+            except KeyError:
+                return self.respond(404, {"error": "Unknown query, expected one of: " + ", ".join(methods)})
+            try:
+                self.respond(200, {"result": method(params)})
+            except (KeyError, ValueError) as e:
+                self.respond(400, {"error": "Invalid query: {}".format(e)})
+
+        def respond(self, status, body):
+            body = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    print("[*] Answering queries on http://{}:{}/".format(host, server.server_address[1]))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Answer queries about a properties file (or snapshot) over HTTP")
+    parser.add_argument("infile")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    args = parser.parse_args()
+
+    print("[*] Indexing {}....".format(args.infile))
+    serve(SnapshotQuery(args.infile), args.host, args.port)
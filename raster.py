@@ -0,0 +1,150 @@
+import json
+import os
+import numpy as np
+from boundary_cache import cache_file
+
+
+# Width (and height) of each cell of the raster, in metres
+CELL_SIZE = 100
+
+# Blocks of up to this many cells on a boundary have all their cells tested at once (with Shapely 2)
+LEAF_CELLS = 256
+
+# Cell values other than BRMAs (which are numbered from 1, in file order)
+OUTSIDE = 0
+STRADDLES = 0xFFFF
+
+
+class BoundaryRaster(object):
+    """Grid of the BRMA each cell of the National Grid falls in, for looking up properties by array index
+
+    A cell holds a BRMA only if that BRMA contains the whole cell (including its edges)
+    and no other BRMA touches it, so any property in the cell is in that BRMA and no other.
+    Cells that no BRMA touches are OUTSIDE, and cells on a boundary are STRADDLES, for
+    which the property has to be checked exactly (see BoundaryIndex.find)
+    """
+
+    def __init__(self, cells, names, x0, y0, cell_size=CELL_SIZE):
+        self.cells = cells
+        self.names = names
+        self.x0 = x0
+        self.y0 = y0
+        self.cell_size = cell_size
+
+    def lookup(self, eastings, northings):
+        """Return the cell value for each of the given grid coordinates"""
+
+        eastings = np.asarray(eastings)
+        northings = np.asarray(northings)
+        rows = (northings - self.y0) // self.cell_size
+        cols = (eastings - self.x0) // self.cell_size
+        inside = (rows >= 0) & (rows < self.cells.shape[0]) & (cols >= 0) & (cols < self.cells.shape[1])
+
+        # Everything beyond the raster is beyond every BRMA
+        values = np.full(len(eastings), OUTSIDE, dtype=np.uint16)
+        values[inside] = self.cells[rows[inside].astype(np.int64), cols[inside].astype(np.int64)]
+        return values
+
+    def name(self, value):
+        """Return the name of the BRMA for a cell value"""
+        return self.names[value - 1]
+
+
+def build_raster(index, path, cell_size=CELL_SIZE):
+    """Rasterise the boundaries in a BoundaryIndex to a file of uint16 cells, returning the raster's origin
+
+    The grid is divided up like a quadtree: a block that one BRMA contains outright, or
+    that none touch, is filled in one go, and only blocks on a boundary are divided further
+    """
+
+    from shapely.geometry import box
+
+    # Shapely 2 can test many cells at once; earlier versions test them one at a time
+    try:
+        from shapely import box as boxes, contains_properly, intersects, prepare
+    except ImportError:
+        boxes = None
+
+    if len(index.names) >= STRADDLES:
+        raise ValueError("Too many BRMAs to rasterise")
+
+    bounds = np.array([brma_shape.bounds for brma_shape in index.shapes])
+    x0 = int(np.floor(bounds[:, 0].min() / cell_size)) * cell_size
+    y0 = int(np.floor(bounds[:, 1].min() / cell_size)) * cell_size
+    cols = int(np.ceil((bounds[:, 2].max() - x0) / cell_size)) + 1
+    rows = int(np.ceil((bounds[:, 3].max() - y0) / cell_size)) + 1
+
+    cells = np.lib.format.open_memmap(path, mode='w+', dtype=np.uint16, shape=(rows, cols))
+    prepared = [index.prepared[name] for name in index.names]
+    if boxes is not None:
+        for brma_shape in index.shapes:
+            prepare(brma_shape)
+
+    def fill_cells(r0, r1, c0, c1, touching):
+        # Decide each cell of a block in the same way as a block of its own
+        col_edges = x0 + np.arange(c0, c1 + 1) * cell_size
+        row_edges = y0 + np.arange(r0, r1 + 1) * cell_size
+        xmin, ymin = np.meshgrid(col_edges[:-1], row_edges[:-1])
+        xmax, ymax = np.meshgrid(col_edges[1:], row_edges[1:])
+        cell_boxes = boxes(xmin, ymin, xmax, ymax)
+
+        touches = np.zeros(cell_boxes.shape, dtype=np.int64)
+        values = np.full(cell_boxes.shape, STRADDLES, dtype=np.uint16)
+        for i in touching:
+            brma_shape = index.shapes[i]
+            touches += intersects(brma_shape, cell_boxes)
+            values[contains_properly(brma_shape, cell_boxes)] = i + 1
+        values[touches == 0] = OUTSIDE
+        values[touches > 1] = STRADDLES
+        cells[r0:r1, c0:c1] = values
+
+    # Blocks of cells (first row, end row, first column, end column), with the BRMAs that might touch them
+    blocks = [(0, rows, 0, cols, list(range(len(index.names))))]
+    while blocks:
+        r0, r1, c0, c1, candidates = blocks.pop()
+        block = box(x0 + c0 * cell_size, y0 + r0 * cell_size, x0 + c1 * cell_size, y0 + r1 * cell_size)
+        touching = [i for i in candidates if prepared[i].intersects(block)]
+
+        if not touching:
+            cells[r0:r1, c0:c1] = OUTSIDE
+        elif len(touching) == 1 and prepared[touching[0]].contains_properly(block):
+            cells[r0:r1, c0:c1] = touching[0] + 1
+        elif r1 - r0 == 1 and c1 - c0 == 1:
+            cells[r0, c0] = STRADDLES
+        elif boxes is not None and (r1 - r0) * (c1 - c0) <= LEAF_CELLS:
+            fill_cells(r0, r1, c0, c1, touching)
+        else:
+            rm = (r0 + r1) // 2 if r1 - r0 > 1 else r1
+            cm = (c0 + c1) // 2 if c1 - c0 > 1 else c1
+            for sr0, sr1 in ((r0, rm), (rm, r1)):
+                for sc0, sc1 in ((c0, cm), (cm, c1)):
+                    if sr0 < sr1 and sc0 < sc1:
+                        blocks.append((sr0, sr1, sc0, sc1, touching))
+
+    cells.flush()
+    del cells
+    return x0, y0
+
+
+def load_raster(index, key, cell_size=CELL_SIZE):
+    """Load the raster for the boundaries cached under the given key (memory-mapped), building it first if needed"""
+
+    path = cache_file(key, "raster-{}m.npy".format(cell_size))
+    meta_path = path + ".json"
+
+    try:
+        with open(meta_path) as meta_file:
+            meta = json.load(meta_file)
+        if meta["names"] != index.names:
+            raise ValueError("Raster was built for different boundaries")
+    except (OSError, ValueError):
+        print("[*] Building BRMA raster ({}m cells)....".format(cell_size))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        x0, y0 = build_raster(index, path + ".tmp.npy", cell_size)
+        os.replace(path + ".tmp.npy", path)
+        meta = {"x0": x0, "y0": y0, "cell_size": cell_size, "names": index.names}
+        with open(meta_path + ".tmp", 'w') as meta_file:
+            json.dump(meta, meta_file)
+        os.replace(meta_path + ".tmp", meta_path)
+
+    return BoundaryRaster(np.load(path, mmap_mode='r'), meta["names"], meta["x0"], meta["y0"], meta["cell_size"])
@@ -0,0 +1,189 @@
+import csv
+import math
+from datetime import datetime
+
+
+# Flags for the ways a listing can be contacted
+PHONE = 1
+EMAIL = 2
+
+# Columns of a properties file that a Listing is made from
+COLUMNS = ["Postcode (District)", "BRMA", "Category", "Monthly Rent", "Weekly Rent", "Listed Date", "Scraped Date",
+           "Affordable", "Contact Phone", "Contact Email"]
+
+
+def _weekly_rent(monthly, weekly):
+    """Return the weekly rent from the monthly rent if there is one, otherwise the weekly rent (NaN if neither)"""
+    try:
+        if monthly:
+            return (float(monthly)*12)/52.1429
+    except ValueError:
+        pass
+    try:
+        return float(weekly)
+    except ValueError:
+        return math.nan
+
+
+class Interner(object):
+    """Gives each distinct value (e.g. a BRMA) a small integer code, so it's stored once however many rows share it
+
+    Each code also has a code for its lower case value, so values can be compared
+    without regard to case (as the analysis does) without lower-casing every row
+    """
+
+    def __init__(self):
+        self.codes = {}
+        self.values = []
+        self.lowered = []
+        self.lower_codes = {}
+        self.lower_values = []
+
+    def __len__(self):
+        return len(self.values)
+
+    def code(self, value):
+        """Return the code for a value, giving it one if it hasn't been seen before"""
+        try:
+            return self.codes[value]
+        except KeyError:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+            self.lowered.append(self.lower_code(value))
+            return code
+
+    def lower_code(self, value):
+        """Return the code for the lower case of a value (the same for every value that differs only in case)"""
+        lowered = value.lower()
+        try:
+            return self.lower_codes[lowered]
+        except KeyError:
+            code = self.lower_codes[lowered] = len(self.lower_values)
+            self.lower_values.append(lowered)
+            return code
+
+
+class Listing(object):
+    """A listing, holding only what the analysis needs, with its values already interned or parsed
+
+    `postcode`, `brma` and `category` are codes (see ListingTable), `rent` is the weekly rent
+    (NaN if there isn't one), dates are datetimes (None if missing) and `contact` is a
+    combination of the PHONE and EMAIL flags
+    """
+
+    __slots__ = ("postcode", "brma", "category", "rent", "listed", "scraped", "affordable", "contact")
+
+    def __init__(self, postcode, brma, category, rent, listed, scraped, affordable, contact):
+        self.postcode = postcode
+        self.brma = brma
+        self.category = category
+        self.rent = rent
+        self.listed = listed
+        self.scraped = scraped
+        self.affordable = affordable
+        self.contact = contact
+
+
+class ListingTable(object):
+    """Turns rows of a properties file (dictionaries, as read by csv.DictReader) into Listings
+
+    Postcodes, BRMAs and categories are interned, and each distinct date is only parsed
+    once, so a table should be kept for as long as its listings are in use
+    """
+
+    def __init__(self):
+        self.postcodes = Interner()
+        self.brmas = Interner()
+        self.categories = Interner()
+        self.dates = {}
+        self.flags = {}
+
+    def _date(self, value, date_format):
+        try:
+            return self.dates[value]
+        except KeyError:
+            try:
+                date = datetime.strptime(value, date_format)
+            except (TypeError, ValueError):
+                date = None
+            self.dates[value] = date
+            return date
+
+    def _flag(self, value):
+        try:
+            return self.flags[value]
+        except KeyError:
+            flag = self.flags[value] = value.lower() == "true"
+            return flag
+
+    def read(self, rows, positions=None):
+        """Yield the Listing for each of the given rows
+
+        Rows are dictionaries keyed by column name, or lists of values if the position of
+        each of the COLUMNS is given (see read_csv)
+        """
+
+        postcode_column, brma_column, category_column, monthly_column, weekly_column, listed_column, \
+            scraped_column, affordable_column, phone_column, email_column = positions or COLUMNS
+
+        # Values already seen are looked up directly, only new ones go through the Interners
+        postcodes, brmas, categories = self.postcodes, self.brmas, self.categories
+        postcode_codes, brma_codes, category_codes = postcodes.codes, brmas.codes, categories.codes
+        dates, flags = self.dates, self.flags
+
+        for row in rows:
+            value = row[postcode_column]
+            postcode = postcode_codes.get(value)
+            if postcode is None:
+                postcode = postcodes.code(value)
+            value = row[brma_column]
+            brma = brma_codes.get(value)
+            if brma is None:
+                brma = brmas.code(value)
+            value = row[category_column]
+            category = category_codes.get(value)
+            if category is None:
+                category = categories.code(value)
+
+            value = row[listed_column]
+            listed = dates[value] if value in dates else self._date(value, "%Y-%m-%d")
+            value = row[scraped_column]
+            scraped = dates[value] if value in dates else self._date(value, "%Y-%m-%d %H:%M:%S")
+            value = row[affordable_column]
+            affordable = flags[value] if value in flags else self._flag(value)
+
+            yield Listing(
+                postcode,
+                brma,
+                category,
+                _weekly_rent(row[monthly_column], row[weekly_column]),
+                listed,
+                scraped,
+                affordable,
+                (PHONE if row[phone_column] else 0) | (EMAIL if row[email_column] else 0)
+            )
+
+    def read_csv(self, csvfile):
+        """Yield the Listing for each row of an open properties file
+
+        Rows are read as lists rather than dictionaries (which is much quicker), using the
+        header to find each column
+        """
+        reader = csv.reader(csvfile)
+        header = next(reader, [])
+        return self.read(reader, [header.index(name) for name in COLUMNS])
+
+    def matcher(self, postcode=None, brma=None, cat=None):
+        """Return a function that checks whether a Listing has the given postcode, BRMA and category (ignoring case, None matching anything)"""
+
+        postcode_code = self.postcodes.lower_code(postcode) if postcode else None
+        brma_code = self.brmas.lower_code(brma) if brma else None
+        cat_code = self.categories.lower_code(cat) if cat else None
+        postcodes, brmas, categories = self.postcodes.lowered, self.brmas.lowered, self.categories.lowered
+
+        def matches(listing):
+            return ((postcode_code is None or postcodes[listing.postcode] == postcode_code)
+                    and (brma_code is None or brmas[listing.brma] == brma_code)
+                    and (cat_code is None or categories[listing.category] == cat_code))
+
+        return matches
@@ -0,0 +1,41 @@
+import gzip
+import hashlib
+import json
+import os
+from datetime import datetime
+from tempfile import NamedTemporaryFile
+
+
+class ResponseCache(object):
+    """On-disk cache of raw API responses, keyed by (a hash of) the request made
+
+    Each response is stored gzipped in its own file, along with the time it was fetched,
+    so a crawl can be replayed later exactly as it was seen at the time
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _path(self, request):
+        key = hashlib.sha256(request.encode()).hexdigest()
+        return os.path.join(self.directory, key[:2], key + ".json.gz")
+
+    def get(self, request):
+        """Return the (text, fetched datetime) of the cached response to a request, or None if there isn't one"""
+        try:
+            with gzip.open(self._path(request), 'rt') as cached:
+                entry = json.load(cached)
+        except (OSError, ValueError):
+            return None
+        return entry["text"], datetime.strptime(entry["fetched"], "%Y-%m-%d %H:%M:%S")
+
+    def put(self, request, text, fetched):
+        """Store the text of the response to a request"""
+        path = self._path(request)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Write to a temporary file first, so a crash can't leave a half-written response behind
+        with NamedTemporaryFile(dir=os.path.dirname(path), delete=False) as tempfile:
+            with gzip.open(tempfile, 'wt') as cached:
+                json.dump({"request": request, "fetched": fetched.strftime("%Y-%m-%d %H:%M:%S"), "text": text}, cached)
+        os.replace(tempfile.name, path)
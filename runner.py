@@ -0,0 +1,379 @@
+import ast
+import hashlib
+import json
+import os
+import time
+
+
+# Where each stage's last result is recorded, within the output directory
+CACHE_DIR = ".stage-cache"
+
+# Modules of this repository are found (to work out the code version of a stage) alongside this file
+MODULE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+DEFAULT_TARGETS = ["analysis", "overview"]
+
+
+class StageInputException(Exception):
+    """This exception is raised if the stages asked for can't be run (e.g. an input file is missing)"""
+    pass
+
+
+class Stage(object):
+    """A stage of the pipeline, which makes its output files from its input files
+
+    `run(inputs, outputs, params)` is called with the paths of the inputs and outputs
+    ("{output}" standing for the output directory, and "{properties}" for the properties
+    file) and the values of the options named
+    in `params`. The code version of a stage is taken from `modules` (the modules its
+    code is in) and every module of this repository they import. A `source` stage (the
+    crawl) collects data rather than making it from its inputs, so it is only run again
+    when forced, when its outputs are missing or to carry on after it stopped part way
+    through, and its outputs are never removed
+    """
+
+    def __init__(self, name, run, inputs, outputs, params=(), modules=(), source=False):
+        self.name = name
+        self.run = run
+        self.inputs = inputs
+        self.outputs = outputs
+        self.params = params
+        self.modules = modules
+        self.source = source
+
+
+# Each stage imports what it needs when it runs, so listing or checking stages is quick
+
+def _crawl(inputs, outputs, params):
+    from properties import snapshot_properties
+    snapshot_properties(outfile=outputs[0], short_run=params["short_run"], min_beds=params["min_beds"],
+                        max_beds=params["max_beds"], workers=params["crawl_workers"])
+
+
+def _dedupe(inputs, outputs, params):
+    from cleaner import remove_duplicates
+    remove_duplicates(infile=inputs[0], outfile=outputs[0])
+
+
+def _boundaries(inputs, outputs, params):
+    from boundaries import SNAP_TOLERANCE, apply_boundaries
+    if params["snap_tolerance"] is not None:
+        snap_tolerance = params["snap_tolerance"]
+    else:
+        snap_tolerance = SNAP_TOLERANCE if params["snap"] else 0
+    apply_boundaries(infile=inputs[0], outfile=outputs[0], overwrite=True, workers=params["workers"],
+                     snap_tolerance=snap_tolerance)
+
+
+def _analysis(inputs, outputs, params):
+    from analysis import analysis_to_file
+    analysis_to_file(infile=inputs[0], outfile=outputs[0], all_categories=params["all_categories"])
+
+
+def _overview(inputs, outputs, params):
+    from analysis import create_overview_by_brma
+    create_overview_by_brma(inputs[0], outputs[0])
+
+
+def _percentiles(inputs, outputs, params):
+    from analysis import percentiles_to_file
+    percentiles_to_file(inputs[0], outputs[0])
+
+
+STAGES = [
+    Stage("crawl", _crawl, ["postcode-districts.csv"], ["{properties}"],
+          params=["short_run", "min_beds", "max_beds", "crawl_workers"], modules=["properties"], source=True),
+    Stage("dedupe", _dedupe, ["{properties}"], ["{output}/deduplicated.csv"], modules=["cleaner"]),
+    Stage("boundaries", _boundaries,
+          ["{output}/deduplicated.csv", "BRMA/gb-brma.shp", "BRMA/gb-brma.dbf", "weekly-lha.csv", "postcode-districts.csv"],
+          ["{output}/boundaries.csv"], params=["workers", "snap", "snap_tolerance"], modules=["boundaries"]),
+    Stage("analysis", _analysis, ["{output}/boundaries.csv", "weekly-lha.csv"], ["{output}/analysis.csv"],
+          params=["all_categories"], modules=["analysis"]),
+    Stage("overview", _overview, ["{output}/boundaries.csv"], ["{output}/by brma.csv"], modules=["analysis"]),
+    Stage("percentiles", _percentiles, ["{output}/boundaries.csv", "weekly-lha.csv"], ["{output}/percentiles.csv"],
+          modules=["analysis"])
+]
+
+
+def code_version(modules, module_dir=MODULE_DIR):
+    """Return a hash of the source of the given modules, and of every module of this repository they import (at any depth)"""
+
+    found = {}
+    pending = list(modules)
+    while pending:
+        name = pending.pop()
+        path = os.path.join(module_dir, name + ".py")
+        if name in found or not os.path.isfile(path):
+            continue
+
+        with open(path, 'rb') as source_file:
+            source = source_file.read()
+        found[name] = hashlib.sha256(source).hexdigest()
+
+        # Including imports made inside functions
+        for node in ast.walk(ast.parse(source)):
+            if isinstance(node, ast.Import):
+                pending.extend(alias.name.split(".")[0] for alias in node.names)
+            elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+                pending.append(node.module.split(".")[0])
+
+    return hashlib.sha256(json.dumps(found, sort_keys=True).encode()).hexdigest()
+
+
+class StageCache(object):
+    """The inputs, parameters and code version each stage was last run with, and the outputs it made
+
+    Files are identified by a hash of their contents. Hashes are remembered along with each
+    file's size and modification time, so a file is only read again once it has changed
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.digests_file = os.path.join(cache_dir, "digests.json")
+        self.digests = self._load(self.digests_file) or {}
+
+    @staticmethod
+    def _load(path):
+        try:
+            with open(path) as cache_file:
+                return json.load(cache_file)
+        except (OSError, ValueError):
+            return None
+
+    def _save(self, path, value):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(path + ".tmp", 'w') as cache_file:
+            json.dump(value, cache_file, indent=1, sort_keys=True)
+        os.replace(path + ".tmp", path)
+
+    def digest(self, path):
+        """Return a hash of a file's contents, or None if it doesn't exist"""
+
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+
+        key = os.path.abspath(path)
+        known = self.digests.get(key)
+        if known and known[0] == stat.st_size and known[1] == stat.st_mtime_ns:
+            return known[2]
+
+        sha = hashlib.sha256()
+        with open(path, 'rb') as infile:
+            for block in iter(lambda: infile.read(1 << 20), b''):
+                sha.update(block)
+        self.digests[key] = [stat.st_size, stat.st_mtime_ns, sha.hexdigest()]
+        self._save(self.digests_file, self.digests)
+        return sha.hexdigest()
+
+    def last_run(self, stage):
+        """Return what the given stage was last run with (and made, if it finished), or None if it hasn't been run"""
+        return self._load(os.path.join(self.cache_dir, stage.name + ".json"))
+
+    def record(self, stage, run):
+        """Record what a stage is being run with, and (once it has finished) the outputs it made"""
+        self._save(os.path.join(self.cache_dir, stage.name + ".json"), run)
+
+
+class Runner(object):
+    """Runs stages of the pipeline (and the stages they depend on), skipping any that are up to date
+
+    A stage is up to date if it has been run before with inputs of the same content, the
+    same parameters and the same code, and its outputs haven't changed since (a source
+    stage only needs to have finished, and its outputs to exist). Stages depend on the
+    stages that make their inputs
+
+    The properties file is collected into the output directory, unless `properties` is
+    given (leave the crawl out of `stages` to use an existing file)
+    """
+
+    def __init__(self, options, stages=STAGES, output="output", properties=None):
+        self.options = options
+        self.stages = {stage.name: stage for stage in stages}
+        self.paths = {"output": output, "properties": properties or os.path.join(output, "properties.csv")}
+        self.cache = StageCache(os.path.join(output, CACHE_DIR))
+
+        self.makers = {}
+        for stage in stages:
+            for path in self.outputs(stage):
+                self.makers[path] = stage.name
+
+    def path(self, path):
+        return path.format(**self.paths)
+
+    def inputs(self, stage):
+        return [self.path(path) for path in stage.inputs]
+
+    def outputs(self, stage):
+        return [self.path(path) for path in stage.outputs]
+
+    def params(self, stage):
+        return {name: self.options[name] for name in stage.params}
+
+    def dependencies(self, stage):
+        return [self.makers[path] for path in self.inputs(stage) if path in self.makers]
+
+    def plan(self, targets):
+        """Return the names of the stages needed for the given targets, in the order they should be run"""
+
+        order = []
+        visiting = set()
+
+        def visit(name):
+            if name in order:
+                return
+            if name in visiting:
+                raise StageInputException("Stages depend on each other: {}".format(name))
+            if name not in self.stages:
+                raise StageInputException("Unknown stage {}, expected one of: {}".format(name, ", ".join(self.stages)))
+            visiting.add(name)
+            for dependency in self.dependencies(self.stages[name]):
+                visit(dependency)
+            visiting.discard(name)
+            order.append(name)
+
+        for target in targets:
+            visit(target)
+        return order
+
+    def state(self, stage):
+        """Return the inputs (content hashes), parameters and code version the stage would run with now"""
+        return {
+            "inputs": {path: self.cache.digest(path) for path in self.inputs(stage)},
+            "params": self.params(stage),
+            "code": code_version(stage.modules)
+        }
+
+    def stale(self, stage, state):
+        """Return why a stage needs to be run, or None if it's up to date"""
+
+        last = self.cache.last_run(stage)
+        if stage.source:
+            for path in self.outputs(stage):
+                if not os.path.isfile(path):
+                    return "output {} missing".format(path)
+            if last is not None and "outputs" not in last:
+                return "last run didn't finish"
+            return None
+
+        if last is None:
+            return "not run before"
+        if "outputs" not in last:
+            return "last run didn't finish"
+        for name in ("inputs", "params", "code"):
+            if last.get(name) != state[name]:
+                return "{} changed".format(name)
+        for path in self.outputs(stage):
+            if last["outputs"].get(path) != self.cache.digest(path):
+                return "output {} changed".format(path)
+        return None
+
+    def run(self, targets=DEFAULT_TARGETS, force=(), dry_run=False):
+        """Run the given stages, and any they depend on that aren't up to date
+
+        Stages named in `force` are run whether they are up to date or not. With `dry_run`,
+        only print what would be run. Returns the names of the stages that were run
+        """
+
+        ran = []
+        for name in self.plan(targets):
+            stage = self.stages[name]
+            upstream = [dependency for dependency in self.dependencies(stage) if dependency in ran]
+
+            missing = [path for path in self.inputs(stage) if self.cache.digest(path) is None and path not in self.makers]
+            if missing:
+                raise StageInputException("Missing input for {}: {}".format(name, ", ".join(missing)))
+
+            if dry_run and upstream:
+                print("[*] {}: may run, after {}".format(name, ", ".join(upstream)))
+                ran.append(name)
+                continue
+
+            state = self.state(stage)
+            reason = "forced" if name in force else self.stale(stage, state)
+            if reason is None:
+                print("[*] {}: up to date, skipping".format(name))
+                continue
+            if dry_run:
+                print("[*] {}: would run ({})".format(name, reason))
+                ran.append(name)
+                continue
+
+            self.run_stage(stage, state, reason)
+            ran.append(name)
+
+        return ran
+
+    def run_stage(self, stage, state, reason):
+        import metrics
+
+        # A stage that finished last time starts again from scratch. A source stage keeps
+        # what it has collected (a crawl adds to its output, or carries on where it stopped)
+        last = self.cache.last_run(stage)
+        if not stage.source and last is not None and "outputs" in last:
+            for path in self.outputs(stage):
+                if os.path.isfile(path):
+                    os.remove(path)
+        self.cache.record(stage, state)
+        for path in self.outputs(stage):
+            if os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        print("[*] Running {} ({})....".format(stage.name, reason))
+        start = time.perf_counter()
+        with metrics.stage(stage.name):
+            stage.run(self.inputs(stage), self.outputs(stage), state["params"])
+        seconds = time.perf_counter() - start
+        print("[*] {} finished in {:.1f}s".format(stage.name, seconds))
+
+        state["outputs"] = {path: self.cache.digest(path) for path in self.outputs(stage)}
+        state["seconds"] = seconds
+        self.cache.record(stage, state)
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Run stages of the pipeline, skipping any whose inputs, parameters and code haven't changed")
+    parser.add_argument("stages", nargs="*", default=DEFAULT_TARGETS, help="stages to run (along with the stages they depend on): {}".format(", ".join(stage.name for stage in STAGES)))
+    parser.add_argument("--output", default="output", help="directory for the output of every stage")
+    parser.add_argument("--properties", help="use this properties file, instead of collecting properties")
+    parser.add_argument("--force", nargs="+", default=[], metavar="STAGE", help="run these stages even if they are up to date")
+    parser.add_argument("--dry-run", action="store_true", help="only show which stages would run")
+    parser.add_argument("--list", action="store_true", help="list the stages, with their inputs and outputs")
+    parser.add_argument("--short-run", action="store_true")
+    parser.add_argument("--min-beds", type=int, default=2)
+    parser.add_argument("--max-beds", type=int, default=2)
+    parser.add_argument("--crawl-workers", type=int, default=1)
+    parser.add_argument("--workers", type=int, default=1, help="processes to apply boundaries with")
+    parser.add_argument("--snap", action="store_true", help="snap properties outside every BRMA to the nearest within 500m")
+    parser.add_argument("--snap-tolerance", type=float, help="snap properties outside every BRMA to the nearest within this many metres")
+    parser.add_argument("--all-categories", action="store_true")
+    args = parser.parse_args(argv)
+
+    stages = [stage for stage in STAGES if stage.name != "crawl"] if args.properties else STAGES
+    runner = Runner(vars(args), stages, args.output, args.properties)
+
+    if args.list:
+        for stage in stages:
+            print("{}: {} -> {}".format(stage.name, ", ".join(runner.inputs(stage)), ", ".join(runner.outputs(stage))))
+        return 0
+
+    if not args.dry_run:
+        import logging
+        import metrics
+        logging.basicConfig(level=logging.INFO, format="%(message)s")
+        metrics.configure(path=os.path.join(args.output, "metrics.jsonl"))
+
+    try:
+        runner.run(args.stages, args.force, args.dry_run)
+    except StageInputException as e:
+        print("[!] {}".format(e))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    import sys
+    sys.exit(main())
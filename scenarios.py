@@ -0,0 +1,86 @@
+import csv
+import numpy as np
+from itertools import product
+from constants import load_LHA
+from analysis import CATEGORIES, aggregate_by_brma
+
+
+def scenario(name=None, rise=0, uplift=None, top_up=0):
+    """Describe an alternative to the current LHA rates
+
+    Under the scenario a listing is affordable if its weekly rent is at most
+        LHA rate * (1 + rise) + uplift[category] + top_up
+
+    `rise` is a fraction (e.g. 0.05 for a 5% rise), `uplift` is a dictionary of extra
+    weekly amounts per category (e.g. {"CAT C": 10}), and `top_up` is an extra weekly
+    amount a tenant could put towards their rent
+    """
+
+    if name is None:
+        name = "rise {:g}%, top-up {:g}".format(rise * 100, top_up)
+        for cat, amount in sorted((uplift or {}).items()):
+            name += ", {} +{:g}".format(cat, amount)
+
+    return {"name": name, "rise": rise, "uplift": uplift or {}, "top_up": top_up}
+
+
+def scenario_grid(rises=(0,), top_ups=(0,), uplifts=({},)):
+    """Return every combination of the given rises, top-ups and uplifts, for sweeping over"""
+    return [scenario(rise=rise, top_up=top_up, uplift=uplift) for rise, top_up, uplift in product(rises, top_ups, uplifts)]
+
+
+def sorted_rents_by_brma(infile, boundaries):
+    """Return the weekly rents of the listings for each BRMA and category, sorted, as arrays indexed [brma][category]"""
+
+    groups = aggregate_by_brma(infile)
+    empty = {"Rents": []}
+
+    return [
+        [np.sort(np.array(groups.get(boundary.lower(), {}).get(cat.lower(), empty)["Rents"], dtype=np.float64)) for cat in CATEGORIES]
+        for boundary in boundaries
+    ]
+
+
+def affordable_counts(infile, scenarios, weekly_LHA=None):
+    """Count the affordable listings for every BRMA, category and scenario
+
+    The rents for each BRMA and category are sorted once, so the number of listings under
+    any threshold is found by binary search, for all of the scenarios at once.
+
+    Returns the list of BRMAs and an array of counts, indexed [brma, category, scenario]
+    (with categories in the order of CATEGORIES)
+    """
+
+    if weekly_LHA is None:
+        weekly_LHA = load_LHA()
+    boundaries = list(weekly_LHA)
+
+    rises = np.array([s["rise"] for s in scenarios], dtype=np.float64)
+    top_ups = np.array([s["top_up"] for s in scenarios], dtype=np.float64)
+    uplifts = np.array([[s["uplift"].get(cat, 0) for s in scenarios] for cat in CATEGORIES], dtype=np.float64)
+
+    rents = sorted_rents_by_brma(infile, boundaries)
+    counts = np.zeros((len(boundaries), len(CATEGORIES), len(scenarios)), dtype=np.int64)
+
+    for i, boundary in enumerate(boundaries):
+        for c, cat in enumerate(CATEGORIES):
+            if len(rents[i][c]):
+                thresholds = float(weekly_LHA[boundary][cat]) * (1 + rises) + uplifts[c] + top_ups
+                counts[i, c] = np.searchsorted(rents[i][c], thresholds, side='right')
+
+    return boundaries, counts
+
+
+def scenarios_to_file(infile, outfile, scenarios):
+    """Write the number of affordable listings (across all categories) for every BRMA under each scenario to a file"""
+
+    boundaries, counts = affordable_counts(infile, scenarios)
+    totals = counts.sum(axis=1)
+
+    with open(outfile, 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(["Broad Rental Market Area"] + [s["name"] for s in scenarios])
+        for boundary, row in zip(boundaries, totals):
+            writer.writerow([boundary] + row.tolist())
+
+    print("Scenarios complete")
@@ -0,0 +1,121 @@
+import csv
+import io
+import os
+from constants import FIELDS
+
+
+class ListingSink(object):
+    """Somewhere to write scraped listings to
+
+    Rows (lists of values, in the order of FIELDS) are written with `write`, and may be
+    buffered until the sink is flushed. `flush` returns a position which `truncate` can
+    later roll the sink back to, so a crawl can discard anything written after the last
+    page it knows to be complete.
+    """
+
+    def write(self, row):
+        raise NotImplementedError
+
+    def write_page(self, rows):
+        """Write a page of rows and flush them, returning the position after the page"""
+        for row in rows:
+            self.write(row)
+        return self.flush()
+
+    def flush(self):
+        raise NotImplementedError
+
+    def truncate(self, position):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class QueueListingSink(ListingSink):
+    """Passes listings on to a queue (e.g. the next stage of a pipeline), rather than storing them
+
+    Rows are put on the queue a page (or flush) at a time, as a list, blocking while the
+    queue is full. Rows can't be taken back once they have been passed on, so the sink
+    can only be "truncated" to the position it is already at
+    """
+
+    def __init__(self, queue):
+        self.queue = queue
+        self.buffer = []
+        self.count = 0
+
+    def write(self, row):
+        self.buffer.append(row)
+
+    def flush(self):
+        if self.buffer:
+            self.queue.put(self.buffer)
+            self.count += len(self.buffer)
+            self.buffer = []
+        return self.count
+
+    def truncate(self, position):
+        if position != self.count:
+            raise ValueError("Rows already passed on to the queue can't be removed")
+        self.buffer = []
+
+
+class CSVListingSink(ListingSink):
+    """Appends listings to a CSV file through a single open file handle
+
+    The header is written if the file is new (or empty). Rows are buffered and written
+    `batch_size` at a time, and flushing syncs them to disk. The file can only be truncated
+    to a position within it, and only if it starts with the header (e.g. not if it has been
+    replaced since the position was recorded)
+    """
+
+    def __init__(self, path, batch_size=500):
+        self.path = path
+        self.batch_size = batch_size
+        self.buffer = []
+        self.file = open(path, 'a', newline='')
+        self.writer = csv.writer(self.file)
+
+        if os.fstat(self.file.fileno()).st_size == 0:
+            self.writer.writerow(FIELDS)
+
+    def _write_buffer(self):
+        self.writer.writerows(self.buffer)
+        self.buffer = []
+
+    def write(self, row):
+        self.buffer.append(row)
+        if len(self.buffer) >= self.batch_size:
+            self._write_buffer()
+
+    def flush(self):
+        self._write_buffer()
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        return os.fstat(self.file.fileno()).st_size
+
+    def truncate(self, position):
+        self.buffer = []
+        self.file.flush()
+
+        header = io.StringIO()
+        csv.writer(header).writerow(FIELDS)
+        header = header.getvalue().encode()
+        with open(self.path, 'rb') as csvfile:
+            starts_with_header = csvfile.read(len(header)) == header
+        if not starts_with_header or not len(header) <= position <= os.path.getsize(self.path):
+            raise ValueError("Position {} doesn't match the contents of {}".format(position, self.path))
+
+        self.file.truncate(position)
+
+    def close(self):
+        if not self.file.closed:
+            self.flush()
+            self.file.close()
@@ -0,0 +1,70 @@
+import os
+import pytest
+from shapely.geometry import Point, box
+import boundaries
+from boundaries import BoundaryAssigner, BoundaryIndex
+from coordinates import latlong2grid_batch
+from districts import DistrictBoundaries
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Two BRMAs (named as in weekly-lha.csv) that overlap between eastings 1000 and 2000
+FIRST, SECOND = "Aberdeen and Shire", "Argyll and Bute"
+
+
+def overlapping_boundaries(x0=0, y0=0):
+    return {FIRST: box(x0, y0, x0 + 2000, y0 + 1000), SECOND: box(x0 + 1000, y0, x0 + 3000, y0 + 1000)}
+
+
+def test_find_prefers_the_previous_brma_then_file_order():
+    index = BoundaryIndex(overlapping_boundaries())
+    overlap = Point(1500, 500)
+
+    assert index.containing(overlap) == [FIRST, SECOND]
+    assert index.find(overlap) == FIRST
+    assert index.find(overlap, preferred=SECOND) == SECOND
+    assert index.find(overlap, preferred=FIRST) == FIRST
+
+    # Likely boundaries only save time, they don't change the result
+    assert index.find(overlap, likely_boundaries=[SECOND]) == FIRST
+    assert index.find(Point(2500, 500), likely_boundaries=[FIRST], preferred=FIRST) == SECOND
+    assert index.find(Point(5000, 500), preferred=FIRST) is None
+
+
+@pytest.fixture
+def assigner(monkeypatch):
+    monkeypatch.chdir(REPO_DIR)
+
+    # Place the BRMAs around a real location, as properties are given by latitude and longitude
+    eastings, northings = latlong2grid_batch([51.5], [-0.1])
+    x0, y0 = int(eastings[0]) - 1500, int(northings[0]) - 500
+    monkeypatch.setattr(boundaries, "load_boundary_files", lambda: overlapping_boundaries(x0, y0))
+    monkeypatch.setattr(boundaries, "source_hash", lambda path: "test")
+    monkeypatch.setattr(boundaries, "load_district_boundaries", lambda index, key: DistrictBoundaries({}))
+    return BoundaryAssigner(overwrite=True, use_raster=False, snap_tolerance=0)
+
+
+def properties(longitudes):
+    return [{"Lat": "51.5", "Long": str(longitude), "Postcode (District)": "E1", "BRMA": "", "Category": "CAT C",
+             "Weekly Rent": "110", "Monthly Rent": "", "Affordable": "", "Snap Distance": ""} for longitude in longitudes]
+
+
+def test_workers_assign_overlaps_as_a_single_process(assigner):
+    # In the second BRMA only, then in the overlap (so in the second BRMA, as the previous property was)
+    longitudes = [-0.088, -0.1, -0.1, -0.112, -0.1]
+    expected = [SECOND, SECOND, SECOND, FIRST, FIRST]
+    assert [row["BRMA"] for row in assigner.assign(properties(longitudes))] == expected
+
+    # As a worker would, with the chunk split just before the overlap
+    assigner.last_boundary = None
+    first_chunk = assigner.assign(properties(longitudes[:1]))
+    assigner.last_boundary = None
+    assigner.pending, assigner.resolving = [], True
+    second_chunk = assigner.assign(properties(longitudes[1:]))
+    assert [row["BRMA"] for row in second_chunk] == [FIRST, FIRST, FIRST, FIRST]
+    assert [position for position, _ in assigner.pending] == [0, 1]
+
+    last_boundary = assigner.resolve(second_chunk, assigner.pending, first_chunk[-1]["BRMA"])
+    assert last_boundary == SECOND
+    assert [row["BRMA"] for row in first_chunk + second_chunk] == expected
+    assert second_chunk[0]["Affordable"] is False
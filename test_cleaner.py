@@ -0,0 +1,44 @@
+import csv
+import pytest
+from constants import FIELDS
+from cleaner import find_duplicate_rows, remove_duplicates
+
+
+@pytest.fixture
+def properties(tmp_path):
+    # 500 listings for 180 properties, in a mixed-up order, with the title part of the URL differing
+    path = str(tmp_path / "properties.csv")
+    with open(path, 'w', newline='') as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=FIELDS)
+        writer.writeheader()
+        for i in range(500):
+            row = dict.fromkeys(FIELDS, "")
+            row.update({"Postcode (District)": "AB{}".format(i // 100), "Title": "Listing {}".format(i),
+                        "Source URL": "https://www.example.co.uk/detail/{}/title/{}".format((i * 7919) % 180, i)})
+            writer.writerow(row)
+    return path
+
+
+def read_rows(path):
+    with open(path, newline='') as csvfile:
+        return list(csv.DictReader(csvfile))
+
+
+def test_external_mode_matches_in_memory(properties, tmp_path):
+    in_memory, external = str(tmp_path / "in_memory.csv"), str(tmp_path / "external.csv")
+
+    assert remove_duplicates(properties, in_memory) == 320
+    assert remove_duplicates(properties, external, external=True) == 320
+    assert read_rows(external) == read_rows(in_memory)
+    assert len(set(row["Source URL"].split("title")[0] for row in read_rows(external))) == 180
+
+
+def test_external_mode_with_a_small_buffer(properties, tmp_path):
+    # Hashes are written out many times over, with a buffer that doesn't divide the rows evenly
+    drop, rows = find_duplicate_rows(properties, str(tmp_path), partitions=7, buffered_rows=33)
+    kept = [row["Title"] for row, dropped in zip(read_rows(properties), drop) if not dropped]
+
+    in_memory = str(tmp_path / "in_memory.csv")
+    remove_duplicates(properties, in_memory)
+    assert rows == 500
+    assert kept == [row["Title"] for row in read_rows(in_memory)]
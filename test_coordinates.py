@@ -0,0 +1,51 @@
+import csv
+import os
+import numpy as np
+import pytest
+from coordinates import check_against_latlong2grid, latlong2grid_batch
+
+# latlong2grid_batch is checked against the OSGridConverter package it replaces, which it
+# has to match exactly (to the metre), as BRMAs are assigned from its results
+pytest.importorskip("OSGridConverter")
+
+DISTRICTS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "postcode-districts.csv")
+
+# Points from Cornwall to Shetland (including points just off the coast), as latitude, longitude
+SAMPLE = [
+    (50.0657, -5.7132),
+    (50.7184, -3.5339),
+    (51.5007, -0.1246),
+    (51.4816, -3.1791),
+    (52.6309, 1.2974),
+    (53.4808, -2.2426),
+    (54.5973, -5.9301),
+    (55.9533, -3.1883),
+    (57.1497, -2.0943),
+    (58.2090, -6.3849),
+    (60.1550, -1.1490),
+    (49.9, -6.3),
+    (61.0, 1.0)
+]
+
+
+def test_sample_matches_latlong2grid():
+    latitudes, longitudes = zip(*SAMPLE)
+    assert check_against_latlong2grid(latitudes, longitudes) == []
+
+
+def test_postcode_districts_match_latlong2grid():
+    latitudes = []
+    longitudes = []
+    with open(DISTRICTS_FILE) as csvfile:
+        for row in csv.DictReader(csvfile):
+            if row["Latitude"]:
+                latitudes.append(float(row["Latitude"]))
+                longitudes.append(float(row["Longitude"]))
+
+    assert check_against_latlong2grid(latitudes, longitudes) == []
+
+
+def test_returns_integer_arrays():
+    eastings, northings = latlong2grid_batch([51.5007], [-0.1246])
+    assert eastings.dtype == np.int64 and northings.dtype == np.int64
+    assert eastings.shape == northings.shape == (1,)
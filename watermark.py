@@ -0,0 +1,64 @@
+import hashlib
+import json
+import os
+
+
+# Size of the blocks hashed at the start of a file and just before its watermark
+HASH_BLOCK = 1 << 16
+
+
+def _block_hash(datafile, start, end):
+    datafile.seek(start)
+    return hashlib.sha256(datafile.read(end - start)).hexdigest()
+
+
+def file_watermark(path, offset=None):
+    """Return a watermark recording that a file has been processed up to `offset` bytes (default: all of it)
+
+    As well as the offset, the watermark records the file's inode and hashes of its first
+    block and of the block before the offset, so a later run can tell whether the file
+    has only been appended to since, or has been rewritten
+    """
+
+    if offset is None:
+        offset = os.path.getsize(path)
+
+    with open(path, 'rb') as datafile:
+        return {
+            "offset": offset,
+            "inode": os.fstat(datafile.fileno()).st_ino,
+            "head": _block_hash(datafile, 0, min(HASH_BLOCK, offset)),
+            "tail": _block_hash(datafile, max(offset - HASH_BLOCK, 0), offset)
+        }
+
+
+def resume_offset(watermark, path):
+    """Return the offset a file can be carried on from, or None if it has changed since the watermark was taken"""
+
+    if not watermark or not os.path.isfile(path):
+        return None
+
+    try:
+        current = file_watermark(path, watermark["offset"]) if os.path.getsize(path) >= watermark["offset"] else None
+    except OSError:
+        return None
+
+    if current != watermark:
+        return None
+    return watermark["offset"]
+
+
+def load_state(path):
+    """Load the saved state of an incremental run, or an empty state if there isn't one"""
+    try:
+        with open(path) as state_file:
+            return json.load(state_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_state(path, state):
+    """Save the state of an incremental run, replacing the old state in one step"""
+    with open(path + ".tmp", 'w') as state_file:
+        json.dump(state, state_file)
+    os.replace(path + ".tmp", path)